@@ -0,0 +1,352 @@
+#! /usr/bin/python2.7
+
+'''Benchmarks for the Long War installer. These build synthetic game trees and mod archives in a temp
+directory and time the installer's hot paths against them, so that changes can be checked for
+regressions.
+
+    ./LongWarBenchmark.py scan --files 1000 10000 100000
+    ./LongWarBenchmark.py --repeat 10 startup
+    ./LongWarBenchmark.py --json all --files 1000 > before.json
+    ./LongWarBenchmark.py --compare before.json all --files 1000
+'''
+
+import os, sys, argparse, json, tempfile, shutil, time, re, logging, collections, subprocess
+
+import LongWarInstaller as installer
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for LongWarInstaller.py')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON instead of a table')
+    parser.add_argument('--repeat', type=int, default=3, help='Times to run each benchmark; the best is kept')
+    parser.add_argument('--compare', metavar='RESULTS',
+                        help='JSON results from an earlier run to compare against; exits with status 1 on regressions')
+    parser.add_argument('--threshold', type=float, default=20, metavar='PERCENT',
+                        help='How much slower than the --compare results counts as a regression (default %(default)s%%)')
+
+    # Options shared by all of the benchmarks
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--files', type=int, nargs='+', default=[1000, 10000], metavar='N',
+                        help='Numbers of mod files to generate')
+    common.add_argument('--size', type=int, default=16, metavar='KB', help='Size of each generated mod file')
+    common.add_argument('-j', '--jobs', type=int, default=1, metavar='N', help='--jobs to pass to the installer')
+
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.add_parser('scan', parents=[common], help='Time scanning an extracted mod for files to install')
+    subparsers.add_parser('install', parents=[common], help='Time --install, --list and --uninstall on a fake game')
+    subparsers.add_parser('zip', parents=[common], help='Time zipping up an extracted mod')
+    subparsers.add_parser('dist', parents=[common], help='Time building a .zip distribution from a mod archive')
+    subparsers.add_parser('startup', help='Time starting the installer for --version, --list and --phone-home-block')
+    subparsers.add_parser('all', parents=[common], help='Run every benchmark')
+
+    args = parser.parse_args()
+    setupLogging()
+    if args.benchmark == 'all':
+        results = [r for name in sorted(BENCHMARKS) for r in BENCHMARKS[name](args)]
+    else:
+        results = BENCHMARKS[args.benchmark](args)
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        for result in results:
+            print('{name:<24} {files:>8} files {seconds:>8.3f}s {filesPerSecond:>12.0f} files/s'.format(**result))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compareResults(baseline, results, args.threshold):
+            sys.exit(1)
+
+def setupLogging():
+    '''Log the way the installer does (everything goes to the install and uninstall logs), but only
+    show warnings on the console so that they don't drown out the results.'''
+    installer.setupConsoleLogging(level=logging.WARNING)
+
+def resetLogging(keep):
+    '''Close and remove every logging handler which isn't in keep, such as the log files the installer
+    opens for each install.'''
+    for handler in installer.getLogHandlers():
+        if handler not in keep:
+            installer.removeLogHandler(handler)
+
+def compareResults(baseline, results, threshold):
+    '''Print how each result compares to the matching one in baseline, and return True if any of them
+    are more than threshold percent slower.'''
+    key = lambda r: (r['name'], r['files'], r.get('jobs'))
+    previous = dict((key(r), r) for r in baseline)
+    regressed = False
+    print('')
+    for result in results:
+        before = previous.get(key(result))
+        if before is None or not before['seconds']:
+            print('{name:<24} {files:>8} files {change:>10}'.format(change='new', **result))
+            continue
+        change = (result['seconds'] - before['seconds']) / before['seconds'] * 100
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressed = True
+        print('{name:<24} {files:>8} files {change:>+9.1f}%{flag}'.format(change=change, flag=flag, **result))
+    return regressed
+
+def bestOf(repeat, func):
+    '''Call func repeat times, and return the shortest wall time it took.'''
+    return min(timed(func) for _ in range(repeat))
+
+def timed(func):
+    '''Call func, and return the wall time it took.'''
+    keep = installer.getLogHandlers()
+    start = time.time()
+    try:
+        func()
+        # Writing the log is part of the cost, even if it happens on another thread
+        installer.flushLogQueue()
+        return time.time() - start
+    finally:
+        resetLogging(keep)
+
+def result(name, files, seconds, **extra):
+    extra.update(name=name, files=files, seconds=seconds, filesPerSecond=files / seconds if seconds else 0)
+    return extra
+
+class BenchmarkDirectory(object):
+    '''Temp directory to run a benchmark in, which is also used as the home directory (for the Feral
+    MacInit folder) and the current directory (for --dist) while it exists.'''
+    def __enter__(self):
+        self.root = tempfile.mkdtemp(prefix='LongWar_Bench_')
+        self.oldHome = os.environ.get('HOME')
+        self.oldCwd = os.getcwd()
+        os.environ['HOME'] = os.path.join(self.root, 'home')
+        os.chdir(self.root)
+        return self.root
+
+    def __exit__(self, type, value, traceback):
+        os.chdir(self.oldCwd)
+        if self.oldHome is not None:
+            os.environ['HOME'] = self.oldHome
+        shutil.rmtree(self.root)
+
+def buildExtractedTree(root, fileCount):
+    '''Create an extracted mod with roughly fileCount files under root, shaped like Long War: mostly
+    .upk files under CookedPCConsole, some localization files, some config files, a few documents
+    at the top level and some files in a directory the installer skips.'''
+    app = os.path.join(root, installer.AbstractExtractor.MOD_FILE_ROOT, 'XComGame')
+    layout = [(os.path.join(app, installer.GameDirectory.COOKED_PC), '.upk', 0.85),
+              (os.path.join(app, installer.GameDirectory.LOCALIZATION, 'INT'), '.int', 0.05),
+              (os.path.join(app, 'Config'), '.ini', 0.04),
+              (os.path.join(root, installer.AbstractExtractor.SKIP_DIRECTORY), '.txt', 0.04),
+              (root, '.txt', 0.02)]
+    for directory, extension, share in layout:
+        count = max(1, int(fileCount * share))
+        for index in range(count):
+            # Keep directories to a realistic size
+            subdirectory = os.path.join(directory, 'pack{:03d}'.format(index // 1000)) if count > 1000 else directory
+            if index % 1000 == 0:
+                installer.makeDirectories(subdirectory)
+            open(os.path.join(subdirectory, 'file{:06d}{}'.format(index, extension)), 'w').close()
+
+def buildModFiles(root, fileCount, sizeKB):
+    '''Create the contents of a mod with fileCount files of sizeKB each under root, and return their
+    paths relative to the 'app' directory. Like Long War, most of them are .upk files, with a few
+    localization files and the config files which also go into the Feral MacInit directory.'''
+    payload = os.urandom(sizeKB * 1024)
+    relativePaths = []
+    for index in range(fileCount):
+        if index < len(installer.FeralDirectory.RENAME_PATHS):
+            relativePath = sorted(installer.FeralDirectory.RENAME_PATHS)[index]
+        elif index % 20 == 0:
+            relativePath = os.path.join('XComGame', installer.GameDirectory.LOCALIZATION, 'INT',
+                                        'File{:06d}.int'.format(index))
+        else:
+            relativePath = os.path.join('XComGame', installer.GameDirectory.COOKED_PC,
+                                        'pack{:03d}'.format(index // 1000), 'File{:06d}.upk'.format(index))
+        path = os.path.join(root, installer.AbstractExtractor.MOD_FILE_ROOT, relativePath)
+        installer.makeDirectories(os.path.dirname(path))
+        # Every file needs different contents, or the backups would all share one stored object
+        with open(path, 'wb') as f:
+            f.write('{:08d}'.format(index))
+            f.write(payload)
+        relativePaths.append(relativePath)
+    skipped = os.path.join(root, installer.AbstractExtractor.SKIP_DIRECTORY)
+    installer.makeDirectories(skipped)
+    with open(os.path.join(skipped, 'Readme.txt'), 'w') as f:
+        f.write('Not installed\n')
+    return relativePaths
+
+def buildModZip(zipPath, fileCount, sizeKB):
+    '''Create a mod archive at zipPath, and return the paths of its files relative to 'app'.'''
+    with installer.TempDirectory('LongWar_Bench_Mod_') as modDir:
+        relativePaths = buildModFiles(modDir, fileCount, sizeKB)
+        installer.zipUpDirectory(zipPath, modDir)
+    # The installer backs this up along with the mod
+    with open(os.path.join(os.path.dirname(zipPath), installer.Distribution.README_FILENAME), 'w') as f:
+        f.write('<html></html>\n')
+    return relativePaths
+
+def buildGameTree(gameRoot, relativePaths):
+    '''Create a fake XCOM install at gameRoot, with an app bundle which has phoned home, a Feral
+    MacInit directory in the home directory, and vanilla copies of every other file in relativePaths
+    (so that half of the mod's files replace existing ones and half are new).'''
+    appBundle = os.path.join(gameRoot, installer.GameDirectory.APP_BUNDLE)
+    for directory in [installer.GameDirectory.PHONE_HOME_INDICATOR, installer.GameDirectory.OVERRIDE_DIRECTORY,
+                      os.path.dirname(installer.GameDirectory.EXECUTABLE)]:
+        installer.makeDirectories(os.path.join(appBundle, directory))
+    with open(os.path.join(appBundle, installer.GameDirectory.EXECUTABLE), 'wb') as f:
+        f.write('vanilla executable')
+    feralRoot = os.path.expanduser(installer.GameDirectory.FERAL_MACINIT)
+    installer.makeDirectories(feralRoot)
+    for feralName in installer.FeralDirectory.RENAME_PATHS.values():
+        with open(os.path.join(feralRoot, feralName), 'w') as f:
+            f.write('vanilla feral file\n')
+    for index, relativePath in enumerate(relativePaths):
+        path = os.path.join(gameRoot, installer.GameDirectory.MOD_FILE_ROOT, relativePath)
+        installer.makeDirectories(os.path.dirname(path))
+        if index % 2 == 0:
+            with open(path, 'wb') as f:
+                f.write('vanilla {}\n'.format(index))
+
+class LegacyPatchFile(object):
+    '''PatchFile as it was before PatchSet and PatchFileClassifier, for comparison.'''
+    def __init__(self, filename, extractDir, extractRoot):
+        self.filename = filename
+        self.extractRoot = extractRoot
+        self.extractedPath = os.path.join(extractDir, filename)
+        modFileRoot = os.path.join(extractRoot, installer.AbstractExtractor.MOD_FILE_ROOT)
+        self.relativePath = installer.getRelativePath(self.extractedPath, modFileRoot)
+        _, extension = os.path.splitext(self.extractedPath)
+        self.isUpk = installer.GameDirectory.COOKED_PC in self.extractedPath and extension in ['.upk']
+        self.isOverride = installer.GameDirectory.LOCALIZATION in self.extractedPath and extension in ['.int', '.esn']
+        self.feralPath = installer.FeralDirectory.feralMacinitCopy(self.relativePath)
+
+def legacyScan(extractRoot):
+    '''The scan as it was done before PatchFileClassifier, for comparison.'''
+    patchFiles = []
+    for root, dirs, files in os.walk(extractRoot):
+        if installer.AbstractExtractor.SKIP_DIRECTORY in dirs:
+            dirs.remove(installer.AbstractExtractor.SKIP_DIRECTORY)
+        for filename in files:
+            if re.search(installer.AbstractExtractor.PATCH_DIRECTORY, root) or re.search(r'txt|jpg$', filename):
+                patchFiles.append(LegacyPatchFile(filename, root, extractRoot))
+    return patchFiles
+
+def scan(extractRoot):
+    extractor = installer.ZipExtractor('benchmark.zip')
+    extractor._scan(extractRoot)
+    return extractor.patchFiles
+
+def benchmarkScan(args):
+    results = []
+    for fileCount in args.files:
+        root = tempfile.mkdtemp(prefix='LongWar_Bench_')
+        try:
+            buildExtractedTree(root, fileCount)
+            found = len(scan(root))
+            results.append(result('scan (legacy)', found, bestOf(args.repeat, lambda: legacyScan(root))))
+            results.append(result('scan', found, bestOf(args.repeat, lambda: scan(root)),
+                                  scandir=installer.scandir is not None))
+        finally:
+            shutil.rmtree(root)
+    return results
+
+def benchmarkInstall(args):
+    '''Install the mod, list the backups and uninstall again, args.repeat times over.'''
+    results = []
+    for fileCount in args.files:
+        with BenchmarkDirectory() as root:
+            modZip = os.path.join(root, 'Long_War_Benchmark.zip')
+            gameRoot = os.path.join(root, 'game')
+            buildGameTree(gameRoot, buildModZip(modZip, fileCount, args.size))
+            times = collections.defaultdict(list)
+            for _ in range(args.repeat):
+                game = installer.GameDirectory(gameRoot)
+                times['install'].append(timed(lambda: game.install(modZip, jobs=args.jobs)))
+                times['list'].append(timed(lambda: installer.GameDirectory(gameRoot).list()))
+                game = installer.GameDirectory(gameRoot)
+                times['uninstall'].append(timed(lambda: game.uninstall(jobs=args.jobs)))
+            for name in ['install', 'list', 'uninstall']:
+                results.append(result(name, fileCount, min(times[name]), jobs=args.jobs, sizeKB=args.size))
+    return results
+
+def benchmarkZip(args):
+    results = []
+    for fileCount in args.files:
+        with BenchmarkDirectory() as root:
+            modDir = os.path.join(root, 'mod')
+            buildModFiles(modDir, fileCount, args.size)
+            zipPath = os.path.join(root, 'benchmark.zip')
+            seconds = bestOf(args.repeat, lambda: installer.zipUpDirectory(zipPath, modDir, jobs=args.jobs))
+            results.append(result('zipUpDirectory', fileCount, seconds, jobs=args.jobs, sizeKB=args.size,
+                                  bytes=os.path.getsize(zipPath)))
+    return results
+
+def benchmarkDist(args):
+    '''Build a .zip distribution, both with an empty extraction cache and with the mod already in it.'''
+    results = []
+    for fileCount in args.files:
+        with BenchmarkDirectory() as root:
+            modZip = os.path.join(root, 'Long_War_Benchmark.zip')
+            buildModZip(modZip, fileCount, args.size)
+            installer.makeDirectories(installer.Distribution.TARGET_DIRECTORY)
+
+            def create(clearCache):
+                if clearCache:
+                    installer.ExtractionCache().clear()
+                installer.Distribution([modZip], args.jobs).create(zipFormat=True)
+
+            results.append(result('dist (cold cache)', fileCount, bestOf(args.repeat, lambda: create(True)),
+                                  jobs=args.jobs, sizeKB=args.size))
+            results.append(result('dist (warm cache)', fileCount, bestOf(args.repeat, lambda: create(False)),
+                                  jobs=args.jobs, sizeKB=args.size))
+    return results
+
+# Runs the installer the way it's run from the command line (compiling it from source), but with the 
+# hosts file replaced, so that --phone-home-block can be timed without root or touching /etc/hosts
+STARTUP_RUNNER = '''
+import sys
+path, hosts = sys.argv[1:3]
+sys.argv[:3] = [path]
+namespace = {'__name__': 'LongWarInstaller', '__file__': path}
+exec(compile(open(path).read(), path, 'exec'), namespace)
+namespace['HostsFileScanner'].HOSTS = hosts
+namespace['main']()
+'''
+
+def benchmarkStartup(args):
+    '''Time whole runs of the installer, in a new python process each time, for the commands which 
+    should return almost instantly. Starting python itself is timed too, for comparison.'''
+    results = []
+    with BenchmarkDirectory() as root:
+        modZip = os.path.join(root, 'Long_War_Benchmark.zip')
+        gameRoot = os.path.join(root, 'game')
+        buildGameTree(gameRoot, buildModZip(modZip, 10, 1))
+        timed(lambda: installer.GameDirectory(gameRoot).install(modZip))
+        hosts = os.path.join(root, 'hosts')
+        script = os.path.abspath(installer.__file__.replace('.pyc', '.py'))
+
+        def resetHosts():
+            with open(hosts, 'w') as f:
+                f.write('127.0.0.1 localhost\n')
+
+        def run(arguments):
+            with open(os.devnull, 'w') as devnull:
+                subprocess.check_call(arguments, stdout=devnull, stderr=devnull)
+
+        commands = [('startup (python)', [sys.executable, '-c', 'pass']),
+                    ('startup --version', ['--version']),
+                    ('startup --list', ['--list', '--game-directory', gameRoot]),
+                    ('startup --phone-home-block', ['--phone-home-block'])]
+        for name, arguments in commands:
+            if arguments[0] != sys.executable:
+                arguments = [sys.executable, '-c', STARTUP_RUNNER, script, hosts] + arguments
+            times = []
+            for _ in range(args.repeat):
+                resetHosts()
+                times.append(timed(lambda: run(arguments)))
+            results.append(result(name, 1, min(times)))
+    return results
+
+BENCHMARKS = {'scan': benchmarkScan, 'install': benchmarkInstall, 'zip': benchmarkZip, 'dist': benchmarkDist, 
+              'startup': benchmarkStartup}
+
+if __name__ == '__main__': main()
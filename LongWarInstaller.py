@@ -2,12 +2,43 @@
 
 '''Long War installer for OS/X.'''
 
-import os, sys, argparse, subprocess, logging, tempfile, shutil, textwrap, re, json, datetime
-import fileinput, errno, zipfile
-import logging.handlers, distutils.spawn
+import os, sys, argparse, logging, textwrap, re, datetime, importlib
+import errno, posixpath, threading, Queue, collections, fcntl, mmap, zlib, time, array
+import contextlib, atexit
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir # Optional backport for python 2.7, https://pypi.python.org/pypi/scandir
+    except ImportError:
+        scandir = None
+
+class LazyModule(object):
+    '''Stand-in for a module which is imported the first time one of its attributes is used, so that 
+    commands which don't need it (like --version or --list) don't spend time importing it.'''
+    def __init__(self, name):
+        self.__name = name
+        self.__module = None
+
+    def __getattr__(self, attribute):
+        if self.__module is None:
+            self.__module = importlib.import_module(self.__name)
+        return getattr(self.__module, attribute)
+
+subprocess, tempfile, shutil, json, zipfile, hashlib, ctypes = map(LazyModule, 
+    ['subprocess', 'tempfile', 'shutil', 'json', 'zipfile', 'hashlib', 'ctypes'])
 
 __version__ = '1.1.2'
 ALIEN = u'\U0001f47d ' # This is goofy
+# Size of the chunks used when streaming file contents around
+COPY_CHUNK_SIZE = 1024 * 1024
+# ioctl to clone a file on copy-on-write filesystems (btrfs, xfs), from linux/fs.h
+FICLONE = 0x40049409
+# Errors meaning a copy strategy isn't supported here, rather than that something went wrong
+UNSUPPORTED_COPY_ERRORS = set(getattr(errno, name) for name in 
+                              ['EOPNOTSUPP', 'ENOTSUP', 'ENOTTY', 'EXDEV', 'EINVAL', 'ENOSYS', 'EPERM', 'EMLINK']
+                              if hasattr(errno, name))
 
 def main():
     parser = argparse.ArgumentParser(description=textwrap.dedent('''\
@@ -19,27 +50,75 @@ def main():
     group.add_argument('--uninstall', nargs='?', const=True, metavar='MOD_VERSION',
                        help='Roll back to a backup and exit (defaults to currently active version)')
     group.add_argument('--list', action='store_true', help='List mod backups and exit')
+    group.add_argument('--verify', nargs='?', const=True, metavar='MOD_VERSION',
+                       help='Check that installed mod files and backups are intact (defaults to currently active version)')
     group.add_argument('--delete', help='Delete a backup and exit', metavar='MOD_VERSION')
     group.add_argument('--phone-home-unblock', action='store_true', help='Unblock phoning home by modifying /etc/hosts')
     group.add_argument('--phone-home-block', action='store_true', help='Block phoning home by modifying /etc/hosts')
     group.add_argument('--dist', nargs='+', help='Build distribution with files as input', metavar='file')
+    group.add_argument('--clear-cache', action='store_true', help='Empty the --dist extraction cache and exit')
+    group.add_argument('--recover', action='store_true', help='Roll back an install which was interrupted and exit')
 
     parser.add_argument('-d', '--debug', action='store_true', help='Show debugging output on console')
     parser.add_argument('--zip', action='store_true', help='Create .zip distribution (instead of .dmg)')
+    parser.add_argument('--cache-size', type=int, default=ExtractionCache.DEFAULT_SIZE_MB, metavar='MB',
+                        help='Maximum size of the --dist extraction cache (default %(default)sMB, 0 disables it)')
     parser.add_argument('--game-directory', help='Directory to use for game installation')
+    parser.add_argument('--all-games', action='store_true',
+                        help='Run --list, --verify, --install or --uninstall on every game found in the Steam libraries')
+    parser.add_argument('--game-jobs', type=int, default=2, metavar='N',
+                        help='With --all-games, number of games to work on at once (default %(default)s)')
     parser.add_argument('--dry-run', action='store_true', 
                         help="Log what would be done, but don't modify game directory")
+    parser.add_argument('--stream', action='store_true',
+                        help='Install .zip files straight from the archive instead of extracting them to a temp directory')
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                        help='Number of files to process at once (default 1)')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Start installing files while the rest of the mod is still being extracted')
+    parser.add_argument('--incremental', action='store_true',
+                        help="Don't back up or copy files which are already identical in the game directory")
+    parser.add_argument('--compress-backups', action='store_true',
+                        help='Compress the files backed up during --install (on --jobs threads)')
+    parser.add_argument('--quick', action='store_true',
+                        help='With --verify, only hash files whose size or modification time have changed')
     parser.add_argument('--version', action='version', version='%(prog)s version ' + __version__)
 
     args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if args.cache_size < 0:
+        parser.error('--cache-size must be at least 0')
+    if args.all_games:
+        if args.game_directory:
+            parser.error('--all-games and --game-directory cannot be used together')
+        if not (args.list or args.verify or args.install or args.uninstall):
+            parser.error('--all-games only works with --list, --verify, --install or --uninstall')
+        if args.game_jobs < 1:
+            parser.error('--game-jobs must be at least 1')
 
     setupConsoleLogging(args.debug)
 
     try:
         if args.dist is not None:
-            make_distribution(args.dist, args.zip)
+            make_distribution(args.dist, args.zip, args.jobs, args.cache_size)
+            return
+
+        if args.clear_cache:
+            ExtractionCache(args.cache_size).clear() ; return
+
+        if args.all_games:
+            if not runOnAllGames(args):
+                sys.exit(1)
             return
 
+        if args.phone_home_block:
+            HostsFileScanner().block() ; return
+
+        if args.phone_home_unblock:
+            HostsFileScanner().unblock() ; return
+
+        # Everything else needs the game directory
         game = GameDirectory(args.game_directory)
 
         if args.delete:
@@ -49,16 +128,17 @@ def main():
             game.list() ; return
 
         if args.uninstall is not None:
-            game.uninstall(args.uninstall) ; return
+            game.uninstall(args.uninstall, args.jobs) ; return
 
-        if args.phone_home_block:
-            HostsFileScanner().block() ; return
+        if args.verify is not None:
+            game.verify(args.verify, args.jobs, args.quick) ; return
 
-        if args.phone_home_unblock:
-            HostsFileScanner().unblock() ; return
+        if args.recover:
+            game.recover() ; return
 
         if args.install:
-            game.install(args.install, args.dry_run) 
+            game.install(args.install, args.dry_run, args.stream, args.jobs, args.incremental, args.pipeline, 
+                         args.compress_backups)
 
             if not game.phoneHomeBlocked:
                 logging.warn(textwrap.dedent('''
@@ -97,6 +177,8 @@ def main():
         abort() # Error printed in GameDirectory.deleteBackupTree()
     except InnoExtractionFailed, e:
         abort(str(e))
+    except CommandTimedOut, e:
+        abort('Running "{}" took longer than {} seconds, so I stopped it.'.format(*e.args))
     except PhoneHomePermissionDenied, e:
         abort('''\
             Permission denied opening {}. You must run this program as root to block or unblock phoning home.'''\
@@ -112,6 +194,18 @@ def main():
 
                 ./LongWarInstaller.py --uninstall
             ''')
+    except InterruptedInstallFound, e:
+        abort('''\
+            An earlier install of "{}" was interrupted before it finished, so the game directory 
+            may be half-patched. Roll it back by running this script with the --recover option:
+
+                ./LongWarInstaller.py --recover
+            '''.format(e))
+    except MissingBackupObjects, e:
+        abort('''\
+            The backups of {} files changed by the interrupted install are missing, so it can't be 
+            rolled back safely. Nothing has been changed, and the install's journal has been kept. 
+            Restore the original files by verifying the game files in Steam.'''.format(e))
     except ActiveBackupFoundDuringDelete, e:
         abort('''\
             The backup you're attempting to delete is currently installed in your game directory. If 
@@ -131,6 +225,17 @@ def main():
 
                 ./LongWarInstaller.py --uninstall Long_War_3_Beta_13-88-3-0b13
             ''')
+    except NoActiveBackupFoundDuringVerify, e:
+        abort('''\
+            You're trying to verify long war, but I can't see a currently active version of it 
+            installed. To check a particular backup, use the --list option to see the backups, 
+            then use an argument to --verify to check that version:
+
+                ./LongWarInstaller.py --list
+                Long_War_3_Beta_13-88-3-0b13: installer version 0.9.1, applied at 2014-08-12 23:07:19
+
+                ./LongWarInstaller.py --verify Long_War_3_Beta_13-88-3-0b13
+            ''')
     except GameHasNotPhonedHome, e:
         msg ='''\
             I couldn't find the Feral Interactive directory in App Support. Before you install Long War, 
@@ -162,17 +267,91 @@ def main():
     except AlreadyUnblocked, e:
         abort('''\
             You're trying to unblock phoning home, but it is already unblocked. You're all set!''')
+    except VerificationFailed, e:
+        abort('''\
+            Some of the files listed above have changed since Long War was installed. This usually 
+            means the game has phoned home or Steam has updated it. To repair the installation, 
+            uninstall and reinstall the mod:
+
+                ./LongWarInstaller.py --uninstall
+                ./LongWarInstaller.py --install
+            ''')
+    except InsufficientDiskSpace, e:
+        abort(textwrap.dedent('''\
+            There isn't enough free disk space to install Long War. Nothing has been changed yet. 
+            Free up some space and try again:
+
+            ''') + '\n'.join('    {}: needs {:,} bytes, but only {:,} are free ({:,} more needed)'
+                            .format(path, needed, free, needed - free) for path, needed, free in e.args[0]))
     except (OSError, IOError), e:
         # This is mildly sloppy
         abort("Can't access {}: {}".format(e.filename, e.strerror))
 
-def make_distribution(files, zipFormat=False):
+def make_distribution(files, zipFormat=False, jobs=1, cacheSize=None):
     '''Given a list of filenames, extract each one in turn into a distribution directory. Then 
     copy the script and README.html to it and make a .dmg image based on the first filename.'''
-    dist = Distribution(files)
+    dist = Distribution(files, jobs, cacheSize)
     filename = dist.create(zipFormat)
     logging.info('Created distribution %s as %s', dist, filename)
 
+def runOnAllGames(args):
+    '''Carry out the action in args on every game directory which can be found, --game-jobs at a time, 
+    then log a report of how it went for each one. Return True if every game succeeded. Installs all 
+    use the same extracted copy of the mod. The games all share the feral directory, so installs 
+    all back up the same copy of it, and uninstalls put it back once at the end.'''
+    games = GameDirectoryFinder().findAll()
+    # Messages about each game are tagged with its number in this list
+    names = dict((root, 'game {}'.format(i + 1)) for i, root in enumerate(games))
+    logging.info('Found %d game directories:', len(games))
+    for root in games:
+        logging.info('  %s: %s', names[root], root)
+
+    # Backups which have been uninstalled, as (time they were installed, backup)
+    uninstalled = []
+
+    def runOn(root, extractor=None, feralSnapshot=None):
+        start = time.time()
+        with logContext(names[root]):
+            try:
+                game = GameDirectory(root)
+                if args.list:
+                    game.list()
+                elif args.verify is not None:
+                    game.verify(args.verify, args.jobs, args.quick)
+                elif args.uninstall is not None:
+                    backup, installed = game.uninstall(args.uninstall, args.jobs, restoreFeral=False)
+                    uninstalled.append((installed, backup))
+                else:
+                    game.install(filename, args.dry_run, args.stream, args.jobs, args.incremental, False,
+                                 args.compress_backups, extractor, feralSnapshot)
+                outcome = 'OK'
+            except InstallError, e:
+                outcome = 'FAILED ({}{})'.format(e.__class__.__name__, ': {}'.format(e) if str(e) else '')
+            except (OSError, IOError), e:
+                outcome = 'FAILED ({})'.format(e)
+        return root, outcome, time.time() - start
+
+    if args.install:
+        filename = findInstallationFile() if args.install is True else args.install
+        # Extract once, up front; pipelining doesn't make sense with several installs reading the files
+        with getExtractor(filename, stream=args.stream) as extractor:
+            with FeralSnapshot(os.path.expanduser(GameDirectory.FERAL_MACINIT)) as snapshot:
+                shared = SharedExtraction(extractor)
+                results = runInPool(lambda root: runOn(root, shared, snapshot), games, args.game_jobs)
+    else:
+        results = runInPool(runOn, games, args.game_jobs)
+
+    if uninstalled:
+        # The first of these to be installed is the one which backed up the feral files before any mod
+        installed, backup = min(uninstalled, key=lambda item: item[0])
+        logging.info('Restoring the feral directory from %s', backup.gameDirectory.root)
+        backup.restoreFeralDirectory()
+
+    logging.info('\nResults:')
+    for root, outcome, seconds in results:
+        logging.info('  %s: %s in %.1fs', names[root], outcome, seconds)
+    return all(outcome == 'OK' for root, outcome, seconds in results)
+
 def abort(errmsg=None):
     if errmsg is not None:
         logging.error(textwrap.dedent(errmsg))
@@ -185,7 +364,7 @@ def isDebug():
 def copyOrWarn(original, destination):
     '''Try to copy the original file to the destination. If it fails, emit a warning.'''
     try:
-        shutil.copy(original, destination)
+        copyFile(original, destination)
     except (OSError, IOError), e:
         logging.warning("Can't copy %s to %s: %s", original, destination, e.strerror)
 
@@ -196,51 +375,732 @@ def removeOrWarn(target):
     except (OSError, IOError), e:
         logging.warning("Can't remove %s: %s", target, e.strerror)
 
+# How many files copyFile() has copied with each strategy, and which strategies have failed as 
+# unsupported for a (strategy, source device, destination device) combination
+_copyStrategyCounts = collections.Counter()
+_unsupportedCopies = set()
+_copyLock = threading.Lock()
+
+def copyFile(original, destination, allowLink=False):
+    '''Copy original to destination (which may be a directory, as with shutil.copy) using the 
+    cheapest method available: a copy-on-write clone, then a hard link, then an in-kernel copy, and 
+    finally an ordinary read/write loop. Hard links are only used if allowLink is True, meaning the 
+    caller knows that neither file will be modified in place afterwards. Return the name of the 
+    strategy which was used.'''
+    if os.path.isdir(destination):
+        destination = os.path.join(destination, os.path.basename(original))
+    breakHardLink(destination)
+    sourceDevice = os.stat(original).st_dev
+    destinationDevice = os.stat(os.path.dirname(os.path.abspath(destination))).st_dev
+
+    strategies = [('reflink', _reflinkCopy)]
+    if allowLink and sourceDevice == destinationDevice:
+        strategies.append(('link', _linkCopy))
+    strategies += [('kernel', _kernelCopy), ('userspace', _userspaceCopy)]
+
+    for name, strategy in strategies:
+        key = (name, sourceDevice, destinationDevice)
+        if key in _unsupportedCopies:
+            continue
+        if strategy(original, destination):
+            break
+        _unsupportedCopies.add(key)
+    if name != 'link':
+        shutil.copymode(original, destination)
+
+    fileEvents.add('Copied %s to %s (%s)', original, destination, name)
+    with _copyLock:
+        _copyStrategyCounts[name] += 1
+    return name
+
+def logCopyStatistics():
+    '''Log how many files were copied with each strategy since the last call, and reset the counts.'''
+    with _copyLock:
+        counts = ', '.join('{}: {}'.format(k, v) for k, v in sorted(_copyStrategyCounts.items()))
+        _copyStrategyCounts.clear()
+    logging.debug('Copy strategies used: %s', counts or 'none')
+
+def breakHardLink(path):
+    '''If path is hard linked to another file, remove it so that writing to path won't change the 
+    other file as well.'''
+    try:
+        if os.lstat(path).st_nlink > 1:
+            os.unlink(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+def _reflinkCopy(original, destination):
+    '''Clone original as destination on filesystems which support it (APFS, btrfs, xfs).'''
+    if sys.platform == 'darwin':
+        clonefile = _getClonefile()
+        if clonefile is None:
+            return False
+        temp = '{}.{}.clone'.format(destination, threading.current_thread().ident)
+        if clonefile(original, temp, 0) != 0:
+            if ctypes.get_errno() in UNSUPPORTED_COPY_ERRORS:
+                return False
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), original)
+        os.rename(temp, destination)
+        return True
+    with open(original, 'rb') as source:
+        with open(destination, 'wb') as target:
+            try:
+                fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+            except IOError, e:
+                if e.errno in UNSUPPORTED_COPY_ERRORS:
+                    return False
+                raise
+    return True
+
+_clonefile = []
+def _getClonefile():
+    '''Return the OS/X clonefile() function (10.12 and later), or None if it isn't available.'''
+    if not _clonefile:
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _clonefile.append(getattr(libc, 'clonefile', None))
+    return _clonefile[0]
+
+def _linkCopy(original, destination):
+    if os.path.lexists(destination):
+        os.unlink(destination)
+    try:
+        os.link(original, destination)
+    except OSError, e:
+        if e.errno in UNSUPPORTED_COPY_ERRORS:
+            return False
+        raise
+    return True
+
+def _kernelCopy(original, destination):
+    '''Copy using copy_file_range() or sendfile(), which avoid copying the data through userspace. 
+    These need a newer python than 2.7, so this mostly does nothing for now.'''
+    copyRange = getattr(os, 'copy_file_range', None)
+    sendfile = getattr(os, 'sendfile', None) if sys.platform.startswith('linux') else None
+    if copyRange is None and sendfile is None:
+        return False
+    with open(original, 'rb') as source:
+        with open(destination, 'wb') as target:
+            size = os.fstat(source.fileno()).st_size
+            offset = 0
+            try:
+                while offset < size:
+                    if copyRange is not None:
+                        sent = copyRange(source.fileno(), target.fileno(), size - offset)
+                    else:
+                        sent = sendfile(target.fileno(), source.fileno(), offset, size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+            except OSError, e:
+                if offset == 0 and e.errno in UNSUPPORTED_COPY_ERRORS:
+                    return False
+                raise
+    return True
+
+def _userspaceCopy(original, destination):
+    with open(original, 'rb') as source:
+        with open(destination, 'wb') as target:
+            shutil.copyfileobj(source, target, COPY_CHUNK_SIZE)
+    return True
+
+def makeDirectories(path):
+    '''Create the directory path and any missing parents. Unlike os.makedirs, it's not an error if 
+    the directory already exists (which can happen when several threads are copying at once).'''
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+def hashFile(path):
+    '''Return the hex SHA-1 digest of the file at path, reading it a chunk at a time.'''
+    with open(path, 'rb') as f:
+        return hashStream(f)
+
+def getSizeOrZero(path):
+    '''Return the size of the file at path, or 0 if it doesn't exist.'''
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def hashStream(f):
+    '''Return the hex SHA-1 digest of everything left to read in the file object f.'''
+    digest = hashlib.sha1()
+    for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
 def getRelativePath(pathname, root):
     '''Given the full path to a file and a directory above it, return the path from the root to the file.'''
     # Weirdly, os.path.commonprefix returns a string match instead of a directory match
     # cf http://stackoverflow.com/questions/21498939/how-to-circumvent-the-fallacy-of-pythons-os-path-commonprefix
     return os.path.relpath(pathname, os.path.commonprefix([root + os.sep, pathname]))
 
-def setupConsoleLogging(debug=False):
-    '''Set up logging to the console. If debug is true, log to the console at DEBUG (else INFO).'''
-    loglevel = logging.DEBUG if debug else logging.INFO
-    rootlogger = logging.getLogger()
+def setupConsoleLogging(debug=False, level=None):
+    '''Set up logging to the console. If debug is true, log to the console at DEBUG (else INFO, unless 
+    another level is given). Log records are written out on a background thread; see startLogQueue().'''
+    if level is None:
+        level = logging.DEBUG if debug else logging.INFO
+    startLogQueue()
     console = logging.StreamHandler()
-    console.setLevel(loglevel)
-    console.setFormatter(logging.Formatter('%(message)s'))
-    rootlogger.addHandler(console)
-    rootlogger.setLevel(logging.DEBUG)
+    console.setLevel(level)
+    console.setFormatter(ContextFormatter('%(message)s'))
+    addLogHandler(console)
 
 def setupFileLogging(logPath):
+    import logging.handlers
     oldLogExists = os.path.isfile(logPath)
     handler = logging.handlers.RotatingFileHandler(logPath, backupCount=9)
     if oldLogExists:
         handler.doRollover() # Hacky but seems to work, we get a new log file per execution
     handler.setLevel(logging.DEBUG)
     handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-7s %(message)s'))
+    # When several games are being worked on at once, each log file only gets its own game's messages
+    handler.addFilter(LogContextFilter(getLogContext()))
+    addLogHandler(handler)
+    logging.debug('Long War Installer, version %s', __version__)
+
+# Python 2 doesn't have logging.handlers.QueueHandler and QueueListener, so here are just enough of them 
+# for startLogQueue()
+class QueueHandler(logging.Handler):
+    '''Pass log records to a queue for a QueueListener to handle on another thread.'''
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def prepare(self, record):
+        # Tracebacks can't be formatted once the stack has unwound, so do it now
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+class QueueListener(object):
+    '''Take log records from a queue on a background thread and pass them to handlers.'''
+    _sentinel = None
+
+    def __init__(self, queue, *handlers, **kwargs):
+        self.queue = queue
+        self.handlers = handlers
+        self.respect_handler_level = kwargs.get('respect_handler_level', False)
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._monitor, name='QueueListener')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if not self.respect_handler_level or record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _monitor(self):
+        while True:
+            record = self.queue.get()
+            try:
+                if record is self._sentinel:
+                    break
+                self.handle(record)
+            finally:
+                self.queue.task_done()
+
+    def stop(self):
+        self.queue.put_nowait(self._sentinel)
+        self._thread.join()
+        self._thread = None
+
+# Once startLogQueue() has been called, handlers are attached to this instead of the root logger
+_logListener = None
+
+def startLogQueue():
+    '''Make logging asynchronous: the root logger just puts records on a queue, and a background 
+    thread formats them and writes them to the console and log files. This keeps slow handlers (like 
+    the log file, which gets a line for every file installed) off the threads doing the work.'''
+    global _logListener
+    if _logListener is not None:
+        return
     rootLogger = logging.getLogger()
-    rootLogger.addHandler(handler)
-    logging.debug('Long War Installer, version {}'.format(__version__))
+    handlers = rootLogger.handlers[:]
+    for handler in handlers:
+        rootLogger.removeHandler(handler)
+    logQueue = Queue.Queue()
+    _logListener = QueueListener(logQueue, *handlers, respect_handler_level=True)
+    _logListener.start()
+    queueHandler = QueueHandler(logQueue)
+    queueHandler.addFilter(LogContextFilter())
+    rootLogger.addHandler(queueHandler)
+    atexit.register(stopLogQueue)
+    _updateLogLevel()
+
+def stopLogQueue():
+    '''Write out any log records still waiting in the queue, and stop the background thread.'''
+    global _logListener
+    if _logListener is None:
+        return
+    fileEvents.flush()
+    listener, _logListener = _logListener, None
+    logging.getLogger().handlers = [h for h in logging.getLogger().handlers if not isinstance(h, QueueHandler)]
+    listener.stop()
+    for handler in listener.handlers:
+        logging.getLogger().addHandler(handler)
+
+def flushLogQueue():
+    '''Wait until every log record logged so far has been written out.'''
+    fileEvents.flush()
+    if _logListener is not None:
+        _logListener.queue.join()
+
+def getLogHandlers():
+    if _logListener is not None:
+        return list(_logListener.handlers)
+    return logging.getLogger().handlers[:]
+
+def addLogHandler(handler):
+    if _logListener is not None:
+        _logListener.handlers += (handler,)
+    else:
+        logging.getLogger().addHandler(handler)
+    _updateLogLevel()
+
+def removeLogHandler(handler):
+    '''Stop logging to handler, and close it.'''
+    flushLogQueue()
+    if _logListener is not None:
+        _logListener.handlers = tuple(h for h in _logListener.handlers if h is not handler)
+    else:
+        logging.getLogger().removeHandler(handler)
+    handler.close()
+    _updateLogLevel()
+
+def _updateLogLevel():
+    '''Set the root logger's level to the lowest level any handler wants, so that records nobody 
+    will see (usually debug records, when there's no log file) are thrown away before being created.'''
+    levels = [h.level or logging.DEBUG for h in getLogHandlers()]
+    logging.getLogger().setLevel(min(levels) if levels else logging.WARNING)
+
+# Which game the current thread is working on, when there's more than one (see --all-games)
+_logContext = threading.local()
+
+def getLogContext():
+    return getattr(_logContext, 'name', None)
+
+@contextlib.contextmanager
+def logContext(name):
+    '''Tag log records made by this thread (and threads it starts with inheritLogContext()) with name.'''
+    previous = getLogContext()
+    _logContext.name = name
+    try:
+        yield
+    finally:
+        _logContext.name = previous
+
+def inheritLogContext(func):
+    '''Wrap func, which is about to be run on a new thread, so that it logs with the caller's context.'''
+    name = getLogContext()
+    def run(*args, **kwargs):
+        with logContext(name):
+            return func(*args, **kwargs)
+    return run
+
+class LogContextFilter(logging.Filter):
+    '''With no arguments, tag each record with the log context of the thread which made it. Given 
+    a context, also drop records from any other context.'''
+    def __init__(self, *context):
+        logging.Filter.__init__(self)
+        self.context = context
+
+    def filter(self, record):
+        if not hasattr(record, 'logContext'):
+            record.logContext = getLogContext()
+        return not self.context or record.logContext == self.context[0]
+
+class ContextFormatter(logging.Formatter):
+    '''Prefix each line of a record with its log context, if it has one.'''
+    def format(self, record):
+        message = logging.Formatter.format(self, record)
+        context = getattr(record, 'logContext', None)
+        if context is None:
+            return message
+        return '\n'.join('[{}] {}'.format(context, line) for line in message.splitlines())
+
+class FileEventBatch(object):
+    '''Debug messages about individual files, which are logged a batch at a time as a single record 
+    instead of one record per message. Messages are only formatted when the batch is written out, 
+    and aren't collected at all unless debug messages are being logged. Each log context (see 
+    logContext()) has its own batch, so that messages end up in the right game's log.'''
+    BATCH_SIZE = 250
+
+    def __init__(self):
+        # Maps log contexts to their (message, args) events
+        self.events = {}
+        self.lock = threading.Lock()
+
+    def add(self, message, *args):
+        if not logging.getLogger().isEnabledFor(logging.DEBUG):
+            return
+        context = getLogContext()
+        batch = None
+        with self.lock:
+            events = self.events.setdefault(context, [])
+            events.append((message, args))
+            if len(events) >= FileEventBatch.BATCH_SIZE:
+                batch = self.events.pop(context)
+        if batch is not None:
+            self._log(context, batch)
+
+    def flush(self):
+        with self.lock:
+            batches, self.events = self.events, {}
+        for context, batch in batches.items():
+            self._log(context, batch)
+
+    def _log(self, context, batch):
+        with logContext(context):
+            logging.debug('%s', FileEventLines(batch))
+
+class FileEventLines(object):
+    '''A batch of file events, formatted as one line each when the log record is written.'''
+    __slots__ = ('events',)
+
+    def __init__(self, events):
+        self.events = events
+
+    def __str__(self):
+        return '{} file events:\n  {}'.format(len(self.events), 
+                                               '\n  '.join(message % args for message, args in self.events))
+
+fileEvents = FileEventBatch()
 
 # TODO move this somewhere logical
-def runCommand(command, debugOptions=[]):
-    '''Run the given command list via subprocess.call() and return the exit value. If we are 
+def runCommand(command, debugOptions=[], timeout=None):
+    '''Run the given command list and return the exit value, logging its output at DEBUG. If we are 
     logging at DEBUG, append the list in debugOptions to command before running it.'''
-    # A fancier script would log innoextract output to the log files if we're at debug
     if isDebug():
         command += debugOptions
-    executable = os.path.basename(command[0])
+    runner = CommandRunner(command, timeout=timeout)
+    runner.start()
+    return runner.wait()
+
+# A line of progress from a running command. kind is 'file' (path is a file it is working on) or 
+# 'percent' (percent is how far through it is)
+ProgressEvent = collections.namedtuple('ProgressEvent', ['kind', 'path', 'percent'])
+
+def parseInnoextractProgress(line):
+    '''Turn a line of innoextract output into a ProgressEvent, or None if it isn't one.'''
+    match = re.match(r'^\s*-\s+"(.+?)"', line)
+    if match is not None:
+        return ProgressEvent('file', match.group(1), None)
+    match = re.search(r'(\d+(?:\.\d+)?)%', line)
+    if match is not None:
+        return ProgressEvent('percent', None, float(match.group(1)))
+    return None
+
+class CommandRunner(object):
+    '''Runs an external command in the background. stdout and stderr are read on their own threads, 
+    so the command can never block on a full pipe, and the caller is free to do other work until it 
+    calls wait(). Each line of output is logged at DEBUG and passed to onLine(stream, line); if 
+    parseProgress is given, it turns lines of stdout into ProgressEvents for onProgress(event).'''
+    # How long to give a cancelled command to exit before killing it
+    CANCEL_GRACE_SECONDS = 5
+
+    def __init__(self, command, timeout=None, onLine=None, parseProgress=None, onProgress=None):
+        self.command = command
+        self.executable = os.path.basename(command[0])
+        self.timeout = timeout
+        self.onLine = onLine
+        self.parseProgress = parseProgress
+        self.onProgress = onProgress
+        self.process = None
+        self.readers = []
+        self.started = None
+
+    def start(self):
+        logging.debug('Running command: %s', ' '.join(self.command))
+        self.started = time.time()
+        self.process = subprocess.Popen(self.command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        for name, stream in [('stdout', self.process.stdout), ('stderr', self.process.stderr)]:
+            reader = threading.Thread(target=self._read, args=(name, stream))
+            reader.daemon = True
+            reader.start()
+            self.readers.append(reader)
+        return self
 
-    logging.debug('Running command: %s', ' '.join(command))
-    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    for output in process.stdout:
-        logging.debug('(%s): %s', executable, output.strip())
+    def _read(self, name, stream):
+        for line in iter(stream.readline, b''):
+            line = line.rstrip()
+            logging.debug('(%s%s): %s', self.executable, '' if name == 'stdout' else ' ' + name, line)
+            if self.onLine is not None:
+                self.onLine(name, line)
+            if name == 'stdout' and self.parseProgress is not None:
+                event = self.parseProgress(line)
+                if event is not None and self.onProgress is not None:
+                    self.onProgress(event)
+        stream.close()
+
+    def poll(self):
+        '''Return the exit value if the command has finished, otherwise None. Raise CommandTimedOut 
+        (after killing it) if it has run past the timeout.'''
+        result = self.process.poll()
+        if result is None and self.timeout is not None and time.time() - self.started > self.timeout:
+            self.cancel()
+            raise CommandTimedOut(' '.join(self.command), self.timeout)
+        return result
 
-    # Potential of deadlocking on large amounts of command output, but should be fine in practice
-    process.wait()
-    logging.debug('Return value: %s', process.returncode)
-    return process.returncode
+    def wait(self):
+        '''Wait for the command to finish and all of its output to be read, and return its exit value. 
+        Raise CommandTimedOut (after killing it) if it runs past the timeout.'''
+        try:
+            while self.poll() is None:
+                time.sleep(0.05)
+        except KeyboardInterrupt:
+            self.cancel()
+            raise
+        for reader in self.readers:
+            while reader.is_alive():
+                reader.join(0.1)
+        logging.debug('Return value: %s', self.process.returncode)
+        return self.process.returncode
+
+    def cancel(self):
+        '''Stop the command: ask nicely first, then kill it if it doesn't exit.'''
+        if self.process is None or self.process.poll() is not None:
+            return
+        logging.debug('Cancelling %s', self.executable)
+        self.process.terminate()
+        deadline = time.time() + CommandRunner.CANCEL_GRACE_SECONDS
+        while self.process.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+def runInPool(func, items, jobs=1):
+    '''Call func with each of items and return a list of the results, in the same order as items. If 
+    jobs is greater than one, the calls are spread over that many worker threads; every item is 
+    processed even if some calls fail, and the first exception is re-raised once all of the items 
+    have been processed. With a single job this is just a loop, which stops at the first exception. 
+    items may be any iterable, and is consumed as the workers become free.'''
+    if jobs <= 1:
+        return [func(item) for item in items]
+
+    def call(item):
+        try:
+            return True, func(item)
+        except Exception:
+            return False, sys.exc_info()
+
+    results = []
+    error = None
+    for succeeded, value in imapOrdered(call, items, jobs):
+        if succeeded:
+            results.append(value)
+        else:
+            results.append(None)
+            error = error or value
+    if error is not None:
+        raise error[0], error[1], error[2]
+    return results
+
+def imapOrdered(func, items, jobs=1):
+    '''Like itertools.imap(func, items), but with the calls spread over jobs worker threads. Results 
+    are yielded in the same order as items, and only a couple of results per job are ever waiting 
+    to be consumed. If a call raises an exception, it is raised when its result would be yielded.'''
+    if jobs <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    work = Queue.Queue()
+    results = {}
+    ready = threading.Condition()
+
+    def worker():
+        while True:
+            job = work.get()
+            if job is None:
+                return
+            index, item = job
+            try:
+                result = (True, func(item))
+            except Exception:
+                result = (False, sys.exc_info())
+            with ready:
+                results[index] = result
+                ready.notify()
+
+    threads = [threading.Thread(target=inheritLogContext(worker)) for _ in range(jobs)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    items = iter(items)
+    submitted = consumed = 0
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and submitted - consumed < jobs * 2:
+                try:
+                    work.put((submitted, next(items)))
+                    submitted += 1
+                except StopIteration:
+                    exhausted = True
+            if consumed == submitted:
+                return
+            with ready:
+                while consumed not in results:
+                    ready.wait(0.1) # Plain wait() would block KeyboardInterrupt
+                succeeded, value = results.pop(consumed)
+            consumed += 1
+            if not succeeded:
+                raise value[0], value[1], value[2]
+            yield value
+    finally:
+        # Drop any work which hasn't started yet, and let the workers exit
+        try:
+            while True:
+                work.get_nowait()
+        except Queue.Empty:
+            pass
+        for _ in threads:
+            work.put(None)
+
+def iterInBackground(items, bufferSize):
+    '''Iterate over items on a background thread, keeping up to bufferSize of them ready, so that 
+    producing the items (say, extracting files) carries on while the caller works on earlier ones. 
+    An exception raised while producing an item is raised again here.'''
+    buffered = Queue.Queue(bufferSize)
+    stopped = threading.Event()
+    finished = object()
+
+    def put(entry):
+        while not stopped.is_set():
+            try:
+                buffered.put(entry, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((True, item)):
+                    return
+            put((True, finished))
+        except Exception:
+            put((False, sys.exc_info()))
+
+    producer = threading.Thread(target=inheritLogContext(produce))
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            try:
+                succeeded, item = buffered.get(timeout=0.1) # Plain get() would block KeyboardInterrupt
+            except Queue.Empty:
+                continue
+            if not succeeded:
+                raise item[0], item[1], item[2]
+            if item is finished:
+                return
+            yield item
+    finally:
+        stopped.set()
+
+class PhaseCounts(object):
+    '''What one timed piece of work handled; see PhaseTimer.phase().'''
+    __slots__ = ('files', 'bytes')
+
+    def __init__(self, files, bytes):
+        self.files = files
+        self.bytes = bytes
+
+class PhaseTimer(object):
+    '''Records the time taken by each phase of an install or uninstall (extracting, backing up, 
+    copying and so on), with the number of files and bytes it handled, so that a slow run can be 
+    pinned on innoextract, the disk or the installer itself. Phases which run on several threads at 
+    once report both their wall time and the total time spent in them by all threads.'''
+    REPORT_SUFFIX = '-timings.json'
+
+    def __init__(self):
+        self.started = time.time()
+        # Maps phase names, in the order they were first seen, to [seconds, files, bytes, first, last]
+        self.phases = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name, files=1, bytes=0):
+        '''Time the body of the with statement as part of the named phase. The PhaseCounts it 
+        yields can be updated if the number of files or bytes isn't known in advance.'''
+        counts = PhaseCounts(files, bytes)
+        start = time.time()
+        try:
+            yield counts
+        finally:
+            self.add(name, start, time.time(), counts.files, counts.bytes)
+
+    def timeIterator(self, name, items, getSize=None):
+        '''Yield each of items, counting the time spent producing them (but not the time spent by the 
+        caller in between) against the named phase. If getSize is given, it is called with each item 
+        to find the number of bytes it represents.'''
+        iterator = iter(items)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            end = time.time()
+            self.add(name, start, end, 1, getSize(item) if getSize is not None else 0)
+            yield item
+
+    def add(self, name, start, end, files=1, bytes=0):
+        with self.lock:
+            phase = self.phases.get(name)
+            if phase is None:
+                self.phases[name] = [end - start, files, bytes, start, end]
+            else:
+                phase[0] += end - start
+                phase[1] += files
+                phase[2] += bytes
+                phase[3] = min(phase[3], start)
+                phase[4] = max(phase[4], end)
+
+    def getReport(self):
+        '''Return the timings as a dictionary which can be saved as JSON.'''
+        phases = collections.OrderedDict()
+        with self.lock:
+            for name, (seconds, files, bytes, first, last) in self.phases.items():
+                wall = last - first
+                phases[name] = {'wallSeconds': wall, 'busySeconds': seconds, 'files': files, 'bytes': bytes,
+                                'filesPerSecond': files / wall if wall else None,
+                                'bytesPerSecond': bytes / wall if wall else None}
+        return {'totalSeconds': time.time() - self.started, 'phases': phases}
+
+    def writeReport(self, path):
+        '''Save the timings as JSON to path, and log a summary of them. Failing to save them is only 
+        worth a warning.'''
+        report = self.getReport()
+        try:
+            with open(path, 'w') as output:
+                json.dump(report, output, indent=2)
+            logging.debug('Timings written to %s', path)
+        except (OSError, IOError), e:
+            logging.warning("Can't save timings to %s: %s", path, e.strerror)
+        logging.info('Finished in %.1fs:', report['totalSeconds'])
+        for name, phase in report['phases'].items():
+            logging.info('  %-12s %7.2fs %7d files %9.1f MB', name, phase['wallSeconds'], phase['files'], 
+                         phase['bytes'] / 1048576.0)
 
 class GameDirectory(object):
     '''Class representing an installed game directory.'''
@@ -257,10 +1117,15 @@ class GameDirectory(object):
     # If this is present, app has phoned home
     PHONE_HOME_INDICATOR = 'Contents/Frameworks/QuincyKit.framework'
     FERAL_MACINIT = '~/Library/Application Support/Feral Interactive/XCOM Enemy Unknown/XEW/MacInit'
+    # Locks for each feral directory; see getFeralLock()
+    _feralLocks = {}
+    _feralLocksLock = threading.Lock()
 
     def __init__(self, root=None):
-        self.backups = {}
-        self.activeBackup = None
+        # Backups are only read when they're needed; see backupSummaries and getBackup()
+        self._backupSummaries = None
+        self._loadedBackups = {}
+        self._phoneHomeBlocked = None
         if root is None:
             root = GameDirectoryFinder().find()
         if not os.path.isdir(root):
@@ -272,27 +1137,42 @@ class GameDirectory(object):
         self.appBundleRoot = os.path.join(self.root, GameDirectory.APP_BUNDLE)
         self.hasPhonedHome = os.path.exists(self.getAppBundlePath(GameDirectory.PHONE_HOME_INDICATOR))
         logging.debug('Game root directory located at %s', self.root)
-        self._scanForBackups()
-
-        self.phoneHomeBlocked = HostsFileScanner().blocked
-        logging.debug('Phone home: %s', 'blocked' if self.phoneHomeBlocked else 'unblocked')
 
         self.feralRoot = os.path.expanduser(GameDirectory.FERAL_MACINIT)
 
-    def _scanForBackups(self):
-        logging.debug('Scanning for available backups...')
-        if not os.path.isdir(self.backupRoot):
-            logging.debug("Can't find backup root %s...", self.backupRoot)
-            return
-        for dirname in os.listdir(self.backupRoot):
-            if dirname == 'dist':
-                continue # May use this location to store mod distrbution files later
-            metadata = os.path.join(self.backupRoot, dirname, Backup.METADATA_FILE)
-            if os.path.isfile(metadata):
-                backup = Backup(dirname, self.backupRoot, self)
-                if backup.active: 
-                    self.activeBackup = backup
-                self.backups[dirname] = backup
+    @property
+    def phoneHomeBlocked(self):
+        if self._phoneHomeBlocked is None:
+            self._phoneHomeBlocked = HostsFileScanner().blocked
+            logging.debug('Phone home: %s', 'blocked' if self._phoneHomeBlocked else 'unblocked')
+        return self._phoneHomeBlocked
+
+    @property
+    def backupSummaries(self):
+        '''Maps the version of every backup to its BackupSummary.'''
+        if self._backupSummaries is None:
+            logging.debug('Scanning for available backups...')
+            if not os.path.isdir(self.backupRoot):
+                logging.debug("Can't find backup root %s...", self.backupRoot)
+                self._backupSummaries = {}
+            else:
+                self._backupSummaries = BackupIndex(self.backupRoot).read()
+        return self._backupSummaries
+
+    @property
+    def activeBackup(self):
+        for version, summary in self.backupSummaries.items():
+            if summary.active:
+                return self.getBackup(version)
+        return None
+
+    def getBackup(self, version):
+        '''Load the full metadata for the given backup version.'''
+        if version not in self._loadedBackups:
+            if version not in self.backupSummaries:
+                raise BackupVersionNotFound(version)
+            self._loadedBackups[version] = Backup(version, self.backupRoot, self)
+        return self._loadedBackups[version]
 
     def _validateHasPhonedHome(self):
         '''Make sure the user has run the game with phone home unblocked at least once, else 
@@ -313,79 +1193,151 @@ class GameDirectory(object):
             logging.info('The game has phoned home at least once.')
         else:
             logging.info('The game has NOT phoned home yet, so Long War will not work.')
-        if not self.backups:
+        for journal in self._findJournals():
+            logging.warning('The install of "%s" was interrupted; run with --recover to undo it.', 
+                            os.path.basename(os.path.dirname(journal)))
+        if not self.backupSummaries:
             logging.info('No backups found in %s.', self.root)
             return
         self._listAllBackups()
 
     def _listAllBackups(self):
-        for key in sorted(self.backups.keys()):
-            logging.info('%s', self.backups[key])
-
-    def install(self, filename=True, dryRun=False):
-        '''Install a mod from the given filename into the installation directory.'''
+        for key in sorted(self.backupSummaries.keys()):
+            logging.info('%s', self.backupSummaries[key])
+
+    def install(self, filename=True, dryRun=False, stream=False, jobs=1, incremental=False, pipeline=False, 
+                compress=False, extractor=None, feralSnapshot=None):
+        '''Install a mod from the given filename into the installation directory. If stream is True, 
+        read the mod files straight out of the archive where possible instead of extracting them first.
+        Up to jobs files will be backed up and copied at once. If incremental is True, files which 
+        are already identical in the game directory are left alone. If pipeline is True, files are 
+        installed as soon as they have been extracted. If compress is True, backed-up files are stored 
+        compressed. If extractor is given, the mod files are taken from it instead of a new extractor 
+        for filename (see SharedExtraction). If feralSnapshot is given, the feral directory is backed 
+        up from it (see FeralSnapshot).'''
         self._validateHasPhonedHome()
         self._validateHasEnemyWith()
 
         if filename is True:
-            scriptDir = os.path.dirname(__file__)
-            zips = [os.path.join(scriptDir, f) for f in os.listdir(scriptDir) if f.endswith('.zip')]
-            zips = [f for f in zips if os.path.isfile(f)] # There is surely a more pythonic way to do this
-            if not zips:
-                raise NoInstallationFilesFound()
-            elif len(zips) > 1:
-                raise TooManyInstallationFilesFound()
-            filename = zips[0]
+            filename = findInstallationFile()
     
-        extractor = getExtractor(filename)
+        if extractor is None:
+            extractor = getExtractor(filename, stream=stream, pipeline=pipeline)
         version = extractor.version
 
+        for journal in self._findJournals():
+            raise InterruptedInstallFound(os.path.basename(os.path.dirname(journal)))
         if self.activeBackup is not None:
             raise ActiveBackupFoundDuringInstall
+        # Make sure everything will fit before writing anything
+        DiskSpacePlanner(self, extractor, filename, dryRun, compress).plan()
 
-        if version in self.backups:
+        if version in self.backupSummaries:
             # Could quit with an error here
             logging.info('Overwriting old backup for mod %s', version)
-            newBackup = self.backups[version]
+            newBackup = self.getBackup(version)
         else:
             # Create new backup
             newBackup = Backup(version, self.backupRoot, self)
-            self.activeBackup = newBackup
+            self._loadedBackups[version] = newBackup
 
         newBackup.setupInstallLog()
         newBackup.copyDistAndScript(filename)
 
         # Extract and patch
-        patcher = Patcher(version, newBackup, self, dryRun)
+        patcher = Patcher(version, newBackup, self, dryRun, jobs, incremental, compress, feralSnapshot)
         patcher.install(extractor)
         
         logging.info('Applied mod version "%s" to game directory.', version)
         logging.info('Install log available in "%s"', newBackup.installLog)
 
     def deleteBackupTree(self, version):
-        if version not in self.backups:
+        if version not in self.backupSummaries:
             logging.error("Can't find backup version \"{}\". The following backups are available:".format(version))
             self._listAllBackups()
             raise BackupVersionNotFound(version)
-        doomedBackup = self.backups[version]
-        if doomedBackup.active:
+        if self.backupSummaries[version].active:
             raise ActiveBackupFoundDuringDelete(version)
-        doomedBackup.deleteBackupTree()
+        self.getBackup(version).deleteBackupTree()
+        del self.backupSummaries[version]
+        self._loadedBackups.pop(version, None)
+        self._collectGarbage()
         logging.info('Deleted backup "%s"', version)
 
-    def uninstall(self, version=True):
-        '''Uninstall the given backup version. If version is True, uninstall the active version.'''
+    def _collectGarbage(self):
+        '''Remove any backed-up file contents which are no longer used by any backup.'''
+        referenced = set()
+        for version in self.backupSummaries:
+            referenced.update(self.getBackup(version).manifest.values())
+        # An interrupted install's backups are only in its journal until --recover puts them back
+        for journal in self._findJournals():
+            referenced.update(entry['digest'] for entry in InstallJournal.read(journal) if entry['op'] == 'backup')
+        ObjectStore(self.backupRoot).collectGarbage(referenced)
+
+    def uninstall(self, version=True, jobs=1, restoreFeral=True):
+        '''Uninstall the given backup version. If version is True, uninstall the active version. Up to 
+        jobs files will be restored at once. If restoreFeral is False, the feral directory is left 
+        alone. Return the backup which was uninstalled, and when it was installed (since uninstalling 
+        updates its applied time).'''
         if version == True:
-            if self.activeBackup is None:
-                raise NoActiveBackupFoundDuringUninstall
             doomedBackup = self.activeBackup
-        elif version not in self.backups:
-            raise BackupVersionNotFound(version)
+            if doomedBackup is None:
+                raise NoActiveBackupFoundDuringUninstall
         else:
-            doomedBackup = self.backups[version]
-        doomedBackup.uninstall()
+            doomedBackup = self.getBackup(version)
+        installed = doomedBackup.applied
+        doomedBackup.uninstall(jobs, restoreFeral)
         logging.info('Reverted to backups for Long War "%s"', doomedBackup.version)
         logging.info('Uninstall log available in "%s"', doomedBackup.uninstallLog)
+        return doomedBackup, installed
+
+    def verify(self, version=True, jobs=1, quick=False):
+        '''Check the files installed by the given backup version (or the active version, if version 
+        is True) against the checksums recorded when it was installed.'''
+        if version == True:
+            backup = self.activeBackup
+            if backup is None:
+                raise NoActiveBackupFoundDuringVerify
+        else:
+            backup = self.getBackup(version)
+        if not backup.verify(jobs, quick):
+            raise VerificationFailed(backup.version)
+        logging.info('All files for "%s" are intact.', backup.version)
+
+    def recover(self):
+        '''Roll back any install which was interrupted before it finished. Only the files named in 
+        the install's journal are touched.'''
+        journals = self._findJournals()
+        if not journals:
+            logging.info('No interrupted installs found in %s.', self.root)
+            return
+        objectStore = ObjectStore(self.backupRoot)
+        for journal in journals:
+            version = os.path.basename(os.path.dirname(journal))
+            entries = InstallJournal.read(journal)
+            if entries and entries[-1]['op'] == 'commit':
+                logging.debug('Install of "%s" finished before it was interrupted', version)
+            else:
+                logging.info('Rolling back interrupted install of "%s" (%d changes)...', version, len(entries))
+                InstallJournal.rollBack(entries, objectStore)
+                logCopyStatistics()
+                logging.info('Rolled back interrupted install of "%s"', version)
+            os.unlink(journal)
+            # The install may have got as far as marking its backup active
+            if version in self.backupSummaries and self.backupSummaries[version].active:
+                backup = self.getBackup(version)
+                backup.active = False
+                backup.writeBackupMetadata()
+                self._backupSummaries = None
+
+    def _findJournals(self):
+        '''Return the journals left behind by installs which didn't finish.'''
+        if not os.path.isdir(self.backupRoot):
+            return []
+        journals = [os.path.join(self.backupRoot, dirname, InstallJournal.FILENAME) 
+                    for dirname in sorted(os.listdir(self.backupRoot)) 
+                    if dirname not in BackupIndex.IGNORE_DIRECTORIES]
+        return [journal for journal in journals if os.path.isfile(journal)]
 
     def getAppBundlePath(self, relativePath):
         '''Given a relative file from a patch, return its location in the installed game tree'''
@@ -399,12 +1351,18 @@ class GameDirectory(object):
         in the installed game tree.'''
         return os.path.join(self.root, GameDirectory.MOD_FILE_ROOT, relativePath)
 
+    def getFeralLock(self):
+        '''Return a lock to hold while backing up or wiping the feral directory. Every game belonging 
+        to a user shares the same one, which matters when working on several games at once.'''
+        with GameDirectory._feralLocksLock:
+            return GameDirectory._feralLocks.setdefault(os.path.realpath(self.feralRoot), threading.Lock())
+
     def nukeFeralDirectory(self):
         '''Delete all files in the feral directory.'''
         logging.debug('Removing files from feral directory %s...', self.feralRoot)
         for fn in (os.path.join(self.feralRoot, f) for f in os.listdir(self.feralRoot)):
             if os.path.isdir(fn): continue # skip .git
-            logging.debug('Removing feral file %s...', fn)
+            fileEvents.add('Removing feral file %s...', fn)
             removeOrWarn(fn)
 
 class FeralDirectory(object):
@@ -436,6 +1394,26 @@ class TempDirectory(object):
             logging.debug('Removing %s', self.tmp)
             shutil.rmtree(self.tmp)
 
+class FeralSnapshot(TempDirectory):
+    '''Copy of the feral MacInit directory, taken before installing into several games at once. The 
+    games all share that directory, so each one backs up this copy instead of the directory itself 
+    (which the games before it will have filled with the mod's files), and only the first one to 
+    get there wipes it.'''
+    TEMP_PREFIX = 'LongWar_Feral_'
+
+    def __init__(self, feralRoot):
+        TempDirectory.__init__(self)
+        self.feralRoot = feralRoot
+        self.cleared = False
+
+    def __enter__(self):
+        TempDirectory.__enter__(self)
+        if os.path.isdir(self.feralRoot):
+            for filename in os.listdir(self.feralRoot):
+                if os.path.isfile(os.path.join(self.feralRoot, filename)):
+                    copyFile(os.path.join(self.feralRoot, filename), self.tmp)
+        return self
+
 class AbstractExtractor(object):
     '''Base class for Inno and Zip extractors.'''
     # Root directory of mod files in the exploded archive
@@ -443,26 +1421,44 @@ class AbstractExtractor(object):
     SKIP_DIRECTORY = 'Long War Files'
     PATCH_DIRECTORY = r'XComGame'
     TEMP_PREFIX = 'LongWar_Extract_'
+    # Directory in the backup root to extract into when the system temp directory won't do
+    LOCAL_TEMP_DIRECTORY = 'tmp'
 
-    def __init__(self, filename, directory=None):
+    def __init__(self, filename, directory=None, stream=False, pipeline=False):
         '''Create a new instance. If directory is None, create a temp directory which will be 
-        deleted on __exit__. Otherwise, extract into directory and do not clean it up afterwards.'''
+        deleted on __exit__. Otherwise, extract into directory and do not clean it up afterwards.
+        If stream is True and the extractor supports it, read files straight from the archive 
+        instead of extracting them (extractors which can't stream ignore this). If pipeline is True, 
+        don't extract anything until iterPatchFiles() is called.'''
         self.filename = filename
         # version is just the file's basename with underscores instead of spaces
         self.version = self.modName(filename)
         self.directory = directory
+        self.stream = stream and directory is None
+        self.pipeline = pipeline
         self.tmp = None
+        self.extractRoot = None
+        self.patchFiles = None
+        self.timer = PhaseTimer()
+        # Where to create the temp directory, if not the system default; see DiskSpacePlanner
+        self.tempRoot = None
 
     def __enter__(self):
         '''Extract the mod files to a temp directory, then scan them'''
         target = self.directory
         if target is None:
-            target = tempfile.mkdtemp(prefix=self.TEMP_PREFIX)
+            if self.tempRoot is not None:
+                makeDirectories(self.tempRoot)
+            target = tempfile.mkdtemp(prefix=self.TEMP_PREFIX, dir=self.tempRoot)
             self.tmp = target
+        self.extractRoot = target
         logging.info('Extracting mod "%s" to temp directory...', self.version)
         logging.debug('Temp directory: %s', target)
-        self.extract(target)
-        self._scan(target)
+        if not self.pipeline:
+            self.extract(target)
+            with self.timer.phase('scan', files=0) as counts:
+                self._scan(target)
+                counts.files = len(self.patchFiles)
         return self
 
     def __exit__(self, type, value, traceback):
@@ -470,58 +1466,180 @@ class AbstractExtractor(object):
         if self.tmp is not None:
             logging.debug('Removing temp extraction directory %s', self.tmp)
             shutil.rmtree(self.tmp)
+            if self.tempRoot is not None:
+                try:
+                    os.rmdir(self.tempRoot)
+                except OSError:
+                    pass # Another install is still using it
 
-    # Could use @abstractmethod per http://stackoverflow.com/a/13646263/87990
     def extract(self, extractRoot):
-        raise NotImplementedError('Subclasses should override extract()!')
+        '''Extract all of the mod files into extractRoot.'''
+        for _ in self._timeExtraction(extractRoot):
+            pass
+
+    def _timeExtraction(self, extractRoot):
+        getSize = lambda relativePath: getSizeOrZero(os.path.join(extractRoot, relativePath))
+        return self.timer.timeIterator('extract', self._extractIncrementally(extractRoot), getSize)
+
+    # Could use @abstractmethod per http://stackoverflow.com/a/13646263/87990
+    def _extractIncrementally(self, extractRoot):
+        '''Extract the mod files into extractRoot, yielding the path of each file (relative to 
+        extractRoot) as soon as it has been completely written.'''
+        raise NotImplementedError('Subclasses should override _extractIncrementally()!')
+
+    def iterPatchFiles(self):
+        '''Yield each of the files to be patched. Normally these have already been found by __enter__; 
+        in pipeline mode the mod is extracted here instead, and files are yielded as soon as they are 
+        on disk, so that they can be installed while the rest are still being extracted.'''
+        if self.patchFiles is not None:
+            for patchfile in self.patchFiles:
+                yield patchfile
+            return
+
+        self.patchFiles = PatchSet(self.extractRoot)
+        seen = set()
+        classifier = PatchFileClassifier(self.extractRoot)
+        for relativePath in self._timeExtraction(self.extractRoot):
+            directory, filename = os.path.split(os.path.join(self.extractRoot, relativePath))
+            if self.SKIP_DIRECTORY in relativePath.split(os.sep)[:-1]:
+                continue
+            if not os.path.isfile(os.path.join(directory, filename)):
+                continue
+            if classifier.isPatchFile(directory, filename):
+                seen.add(relativePath)
+                yield self.patchFiles.add(directory, filename, *classifier.describe(directory, filename))
+
+        # In case the extractor didn't tell us about everything, pick up any stragglers
+        for directory, filename in self._walk(self.extractRoot, classifier):
+            if getRelativePath(os.path.join(directory, filename), self.extractRoot) not in seen:
+                logging.debug('Found unreported file %s after extraction', os.path.join(directory, filename))
+                yield self.patchFiles.add(directory, filename, *classifier.describe(directory, filename))
+        logging.debug('Extracted %d mod files from %s', len(self.patchFiles), self.version)
 
     def _scan(self, extractRoot):
         '''After extraction, look in extracted directory to find applicable files.'''
-        self.patchFiles = []
-
-        for root, dirs, files in os.walk(extractRoot):
-            if self.SKIP_DIRECTORY in dirs:
-                dirs.remove(self.SKIP_DIRECTORY)
-            if re.search(self.PATCH_DIRECTORY, root):
-                for filename in files:
-                    patchfile = PatchFile(filename, root, extractRoot)
-                    self.patchFiles.append(patchfile)
-            else:
-                for filename in files:
-                    if re.search(r'txt|jpg$', filename):
-                        patchfile = PatchFile(filename, root, extractRoot)
-                        self.patchFiles.append(patchfile)
+        self.patchFiles = PatchSet(extractRoot)
+        classifier = PatchFileClassifier(extractRoot)
+        for directory, filename in self._walk(extractRoot, classifier):
+            self.patchFiles.add(directory, filename, *classifier.describe(directory, filename))
         logging.debug('Extracted %d mod files from %s', len(self.patchFiles), self.version)
 
+    def _walk(self, extractRoot, classifier):
+        '''Yield (directory, filename) for every applicable file under extractRoot.'''
+        for root, files in self._listFiles(extractRoot):
+            for filename in files:
+                if classifier.isPatchFile(root, filename):
+                    yield root, filename
+
+    def _listFiles(self, extractRoot):
+        '''Yield (directory, filenames) for every directory under extractRoot, except skipped ones. 
+        Uses scandir if it's available, which saves a stat() call per file.'''
+        if scandir is None:
+            for root, dirs, files in os.walk(extractRoot):
+                if self.SKIP_DIRECTORY in dirs:
+                    dirs.remove(self.SKIP_DIRECTORY)
+                yield root, files
+            return
+        pending = [extractRoot]
+        while pending:
+            root = pending.pop()
+            files = []
+            for entry in scandir(root):
+                if not entry.is_dir():
+                    files.append(entry.name)
+                elif entry.name != self.SKIP_DIRECTORY and not entry.is_symlink(): # Like os.walk
+                    pending.append(entry.path)
+            yield root, files
+
     # TODO this should be a function
     @staticmethod
     def modName(path):
         return os.path.splitext(os.path.basename(path))[0].replace(' ', '_')
 
-def getExtractor(installationFilePath, targetDirectory=None):
+def findInstallationFile():
+    '''Return the one mod file next to this script, for --install without a filename.'''
+    scriptDir = os.path.dirname(__file__)
+    zips = [os.path.join(scriptDir, f) for f in os.listdir(scriptDir) if f.endswith('.zip')]
+    zips = [f for f in zips if os.path.isfile(f)] # There is surely a more pythonic way to do this
+    if not zips:
+        raise NoInstallationFilesFound()
+    elif len(zips) > 1:
+        raise TooManyInstallationFilesFound()
+    return zips[0]
+
+class SharedExtraction(object):
+    '''Wraps an extractor which has already been entered, so that installs into several games at 
+    once can all use the same extracted files. Entering and exiting it does nothing; the extractor 
+    is cleaned up by whoever entered it.'''
+    def __init__(self, extractor):
+        self.extractor = extractor
+        self.version = extractor.version
+        self.timer = extractor.timer
+
+    def __enter__(self):
+        return self.extractor
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+def getExtractor(installationFilePath, targetDirectory=None, stream=False, pipeline=False):
     '''Factory method - return the correct instance based on the file's extension.'''
     classmap = {'.exe': InnoExtractor, '.zip': ZipExtractor}
     _, extension = os.path.splitext(installationFilePath)
     klass = classmap[extension]
-    return klass(installationFilePath, targetDirectory)
+    return klass(installationFilePath, targetDirectory, stream, pipeline)
 
 class InnoExtractor(AbstractExtractor):
     TEMP_PREFIX = 'LongWar_ExtInno_'
-    def __init__(self, filename, directory=None):
-        super(InnoExtractor, self).__init__(filename, directory)
+    # Give up on innoextract if it takes longer than this
+    TIMEOUT_SECONDS = 30 * 60
+    def __init__(self, filename, directory=None, stream=False, pipeline=False):
+        super(InnoExtractor, self).__init__(filename, directory, stream, pipeline)
+        import distutils.spawn
         self.innoextract = distutils.spawn.find_executable('innoextract')
+        self.filesExtracted = 0
 
-    def extract(self, extractRoot):
-        '''Extract the mod files to a temp directory, then scan them'''
+    def _extractIncrementally(self, extractRoot):
+        '''Run innoextract in the background. It names each file as it starts on it, so a file is 
+        complete once innoextract names the next one (or exits).'''
         self._validate()
 
         command = [self.innoextract, '--extract', '--progress=0', '--color=0', #'--silent', 
                    '--output-dir', extractRoot, self.filename]
 
-        result = runCommand(command)
+        events = Queue.Queue()
+        runner = CommandRunner(command, timeout=InnoExtractor.TIMEOUT_SECONDS, 
+                               parseProgress=parseInnoextractProgress, onProgress=events.put)
+        runner.start()
+        try:
+            previous, result = None, None
+            while result is None or not events.empty():
+                try:
+                    event = events.get(timeout=0.1)
+                except Queue.Empty:
+                    if runner.poll() is not None:
+                        result = runner.wait() # All of the output has been read after this
+                    continue
+                self.onProgress(event)
+                if event.kind != 'file':
+                    continue
+                if previous is not None:
+                    yield previous
+                previous = os.path.normpath(event.path)
+            if previous is not None and result == 0:
+                yield previous
+        finally:
+            runner.cancel() # If we are abandoned half way through
+
+        logging.debug('innoextract reported %d files', self.filesExtracted)
         if result != 0:
             raise InnoExtractionFailed('Running "{}" returned {}!'.format(' '.join(command), result))
 
+    def onProgress(self, event):
+        '''Called with each ProgressEvent from innoextract as it runs.'''
+        if event.kind == 'file':
+            self.filesExtracted += 1
+
     def _validate(self):
         '''Make sure the relevant stuff is present, else throw an error'''
         if self.innoextract is None:
@@ -532,29 +1650,170 @@ class InnoExtractor(AbstractExtractor):
 
 class ZipExtractor(AbstractExtractor):
     TEMP_PREFIX = 'LongWar_ExtZip_'
-    def __init__(self, filename, directory=None):
-        super(ZipExtractor, self).__init__(filename, directory)
+    def __init__(self, filename, directory=None, stream=False, pipeline=False):
+        super(ZipExtractor, self).__init__(filename, directory, stream, pipeline)
+        self.archive = None
 
-    def extract(self, extractRoot):
-        '''Extract the mod files to a temp directory, then scan them'''
+    def __enter__(self):
+        '''In streaming mode, open the archive and scan its central directory instead of extracting it'''
+        if not self.stream:
+            return super(ZipExtractor, self).__enter__()
+        if not os.path.isfile(self.filename):
+            raise LongWarFileNotFound(self.filename)
+        logging.info('Reading mod "%s" directly from archive...', self.version)
+        with self.timer.phase('scan', files=0) as counts:
+            self.archive = zipfile.ZipFile(self.filename, 'r')
+            self._scanArchive()
+            counts.files = len(self.patchFiles)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+        super(ZipExtractor, self).__exit__(type, value, traceback)
+
+    def _scanArchive(self):
+        '''Find applicable files using the zip file's central directory, without extracting anything.'''
+        self.patchFiles = list(self._iterArchivePatchFiles(self.archive))
+        logging.debug('Found %d mod files in archive %s', len(self.patchFiles), self.version)
+
+    def _iterArchivePatchFiles(self, archive):
+        '''Yield a ZipPatchFile for each applicable file in archive. Members are classified as if 
+        the archive had been extracted to the root directory.'''
+        classifier = PatchFileClassifier(os.sep)
+        for info in archive.infolist():
+            if info.filename.endswith('/'):
+                continue # Directory entry
+            directory, filename = posixpath.split(info.filename)
+            if self.SKIP_DIRECTORY in directory.split('/'):
+                continue
+            directory = os.path.join(os.sep, directory)
+            if classifier.isPatchFile(directory, filename):
+                yield ZipPatchFile(info, archive, *classifier.describe(directory, filename))
+
+    def _extractIncrementally(self, extractRoot):
         logging.debug('Unzipping zip file %s', self.filename)
         with zipfile.ZipFile(self.filename, 'r') as newZip:
             for member in newZip.namelist():
-                logging.debug('Extracting %s', member)
+                fileEvents.add('Extracting %s', member)
                 newZip.extract(member, extractRoot)
-
-class PatchFile(object):
-    '''Represents a single file to be patched from the mod'''
-    def __init__(self, filename, extractDir, extractRoot):
-        self.filename = filename
+                if not member.endswith('/'):
+                    yield os.path.normpath(member)
+
+class PatchFileClassifier(object):
+    '''Decides which extracted files should be installed, and what sort of files they are. The rules 
+    are compiled once, and everything which depends only on a file's directory is worked out once per 
+    directory, so classifying each file only takes a couple of lookups.'''
+    # Maps extensions to the flag they set on a PatchFile, and the directory they must be under for it
+    EXTENSION_RULES = {'.upk': ('isUpk', GameDirectory.COOKED_PC),
+                       '.int': ('isOverride', GameDirectory.LOCALIZATION),
+                       '.esn': ('isOverride', GameDirectory.LOCALIZATION)}
+
+    def __init__(self, extractRoot):
         self.extractRoot = extractRoot
-        self.extractedPath = os.path.join(extractDir, filename)
-        # Path relative to the 'app' directory
-        self.relativePath = getRelativePath(self.extractedPath, os.path.join(self.extractRoot, AbstractExtractor.MOD_FILE_ROOT))
-        _, extension = os.path.splitext(self.extractedPath)
-        self.isUpk = GameDirectory.COOKED_PC in self.extractedPath and extension in ['.upk']
-        self.isOverride = GameDirectory.LOCALIZATION in self.extractedPath and extension in ['.int', '.esn']
-        self.feralPath = FeralDirectory.feralMacinitCopy(self.relativePath)
+        self.modFileRoot = os.path.join(extractRoot, AbstractExtractor.MOD_FILE_ROOT)
+        self.modFilePrefix = AbstractExtractor.MOD_FILE_ROOT + os.sep
+        self.patchDirectory = re.compile(AbstractExtractor.PATCH_DIRECTORY)
+        self.patchFilename = re.compile(r'txt|jpg$')
+        # Maps directories to (all files are patch files, relative path prefix, extension -> flag)
+        self.directories = {}
+
+    def _getDirectoryRules(self, directory):
+        rules = self.directories.get(directory)
+        if rules is None:
+            relative = '' if directory == self.extractRoot else getRelativePath(directory, self.extractRoot)
+            if relative == AbstractExtractor.MOD_FILE_ROOT:
+                prefix = ''
+            elif relative.startswith(self.modFilePrefix):
+                prefix = relative[len(self.modFilePrefix):] + os.sep
+            else:
+                prefix = None # Outside the 'app' directory, so leave it to getRelativePath()
+            flags = dict((extension, flag) for extension, (flag, parent) in PatchFileClassifier.EXTENSION_RULES.items()
+                         if parent in relative)
+            rules = (self.patchDirectory.search(directory) is not None, prefix, flags)
+            self.directories[directory] = rules
+        return rules
+
+    def isPatchFile(self, directory, filename):
+        '''Return True if the file in the given directory of the archive should be installed.'''
+        return self._getDirectoryRules(directory)[0] or self.patchFilename.search(filename) is not None
+
+    def describe(self, directory, filename):
+        '''Return (relativePath, isUpk, isOverride) for the file, where relativePath is relative to 
+        the 'app' directory.'''
+        _, prefix, flags = self._getDirectoryRules(directory)
+        if prefix is None:
+            relativePath = getRelativePath(os.path.join(directory, filename), self.modFileRoot)
+        else:
+            relativePath = prefix + filename
+        flag = flags.get(os.path.splitext(filename)[1])
+        return relativePath, flag == 'isUpk', flag == 'isOverride'
+
+class PatchSet(object):
+    '''Compact storage for the files to be patched from an extracted mod, which can run to tens of 
+    thousands of files for big overhaul packs. Each directory name is stored once, the flags for each 
+    file are packed into a byte, and full paths are only built when they are asked for. Iterating 
+    yields lightweight PatchFile views.'''
+    UPK, OVERRIDE = 1, 2
+
+    def __init__(self, extractRoot):
+        self.extractRoot = extractRoot
+        self.directories = []
+        # For each directory, the relativePath of its files minus their filenames (None if that varies)
+        self.relativePrefixes = []
+        self.directoryIndexes = {}
+        self.filenames = []
+        self.fileDirectories = array.array('I')
+        self.flags = array.array('B')
+        # relativePaths which aren't just their directory's prefix plus their filename
+        self.unusualRelativePaths = {}
+
+    def add(self, directory, filename, relativePath, isUpk, isOverride):
+        '''Add a file, returning a PatchFile view of it.'''
+        directoryIndex = self.directoryIndexes.get(directory)
+        if directoryIndex is None:
+            directoryIndex = self.directoryIndexes[directory] = len(self.directories)
+            self.directories.append(directory)
+            prefix = relativePath[:-len(filename)] if relativePath.endswith(filename) else None
+            self.relativePrefixes.append(prefix if not prefix or prefix.endswith(os.sep) else None)
+        index = len(self.filenames)
+        self.filenames.append(filename)
+        self.fileDirectories.append(directoryIndex)
+        self.flags.append((PatchSet.UPK if isUpk else 0) | (PatchSet.OVERRIDE if isOverride else 0))
+        prefix = self.relativePrefixes[directoryIndex]
+        if prefix is None or prefix + filename != relativePath:
+            self.unusualRelativePaths[index] = relativePath
+        return PatchFile(self, index)
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self.filenames):
+            raise IndexError(index)
+        return PatchFile(self, index)
+
+    def __iter__(self):
+        for index in xrange(len(self.filenames)):
+            yield PatchFile(self, index)
+
+    def getDirectory(self, index):
+        return self.directories[self.fileDirectories[index]]
+
+    def getRelativePath(self, index):
+        relativePath = self.unusualRelativePaths.get(index)
+        if relativePath is None:
+            relativePath = self.relativePrefixes[self.fileDirectories[index]] + self.filenames[index]
+        return relativePath
+
+class BasePatchFile(object):
+    '''Behaviour shared by all files to be patched from the mod, wherever they are stored.'''
+    __slots__ = ()
+
+    @property
+    def feralPath(self):
+        return FeralDirectory.feralMacinitCopy(self.relativePath)
 
     def __repr__(self):
         spec = ''
@@ -575,8 +1834,214 @@ class PatchFile(object):
         else:
             return os.path.join(gameRoot, self.relativePath)
 
+class PatchFile(BasePatchFile):
+    '''Represents a single file to be patched from the mod, extracted on disk. This is a view onto 
+    one entry in a PatchSet.'''
+    __slots__ = ('patchSet', 'index')
+
+    def __init__(self, patchSet, index):
+        self.patchSet = patchSet
+        self.index = index
+
+    @property
+    def filename(self):
+        return self.patchSet.filenames[self.index]
+
+    @property
+    def extractRoot(self):
+        return self.patchSet.extractRoot
+
+    @property
+    def extractedPath(self):
+        return os.path.join(self.patchSet.getDirectory(self.index), self.filename)
+
+    @property
+    def relativePath(self):
+        '''Path relative to the 'app' directory'''
+        return self.patchSet.getRelativePath(self.index)
+
+    @property
+    def isUpk(self):
+        return bool(self.patchSet.flags[self.index] & PatchSet.UPK)
+
+    @property
+    def isOverride(self):
+        return bool(self.patchSet.flags[self.index] & PatchSet.OVERRIDE)
+
+    def copyTo(self, target):
+        '''Copy the contents of this file to target, emitting a warning if it fails.'''
+        copyOrWarn(self.extractedPath, target)
+
+    def getSize(self):
+        return os.path.getsize(self.extractedPath)
+
+    def getHash(self):
+        return hashFile(self.extractedPath)
+
+class ZipPatchFile(BasePatchFile):
+    '''A file to be patched which is read straight out of the mod's zip archive, rather than from 
+    an extracted copy in a temp directory.'''
+    __slots__ = ('info', 'archive', 'filename', 'relativePath', 'isUpk', 'isOverride')
+    extractRoot = None
+    extractedPath = None
+
+    def __init__(self, info, archive, relativePath, isUpk, isOverride):
+        self.filename = posixpath.basename(info.filename)
+        self.info = info
+        self.archive = archive
+        self.relativePath = relativePath
+        self.isUpk = isUpk
+        self.isOverride = isOverride
+
+    def copyTo(self, target):
+        '''Stream the archive member to target chunk by chunk, emitting a warning if it fails.'''
+        try:
+            breakHardLink(target)
+            with self.archive.open(self.info) as source:
+                with open(target, 'wb') as destination:
+                    shutil.copyfileobj(source, destination, COPY_CHUNK_SIZE)
+        except (OSError, IOError), e:
+            logging.warning("Can't copy %s to %s: %s", self.info.filename, target, e.strerror)
+
+    def getSize(self):
+        return self.info.file_size
+
+    def getHash(self):
+        with self.archive.open(self.info) as source:
+            return hashStream(source)
+
+class ObjectStore(object):
+    '''Content-addressed storage for backed-up files, shared by all of the backups. Each file is 
+    stored once, named after the SHA-1 hash of its contents, so the vanilla files which several 
+    versions of Long War all back up only take up space once. Objects may also be stored compressed, 
+    each in its own zlib stream, so any one of them can still be restored on its own.'''
+    DIRECTORY = 'objects'
+    COMPRESSED_SUFFIX = '.z'
+    COMPRESSION_LEVEL = 6
+
+    def __init__(self, allBackupsRoot):
+        self.root = os.path.join(allBackupsRoot, ObjectStore.DIRECTORY)
+
+    def getObjectPath(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def findObject(self, digest):
+        '''Return the path to the stored object with the given hash and whether it is compressed, or 
+        (None, False) if it isn't stored.'''
+        objectPath = self.getObjectPath(digest)
+        if os.path.isfile(objectPath):
+            return objectPath, False
+        if os.path.isfile(objectPath + ObjectStore.COMPRESSED_SUFFIX):
+            return objectPath + ObjectStore.COMPRESSED_SUFFIX, True
+        return None, False
+
+    def store(self, original, allowLink=False, compress=False):
+        '''Add the file original to the store if its contents aren't there already, and return its 
+        hash. If allowLink is true the object may be a hard link to original (see copyFile()). If 
+        compress is true, new objects are stored compressed.'''
+        if compress:
+            return self._storeCompressed(original)
+        digest = hashFile(original)
+        objectPath = self.getObjectPath(digest)
+        if self.findObject(digest)[0] is not None:
+            fileEvents.add('Contents of %s already stored as %s', original, digest)
+            return digest
+        makeDirectories(os.path.dirname(objectPath))
+        # Copy then rename, so a half-written object never looks like a complete one
+        temp = '{}.{}.tmp'.format(objectPath, threading.current_thread().ident)
+        copyFile(original, temp, allowLink)
+        os.rename(temp, objectPath)
+        fileEvents.add('Stored %s as %s', original, digest)
+        return digest
+
+    def _storeCompressed(self, original):
+        '''Hash and compress original in a single pass. The hash isn't known until the end, so the 
+        compressed data goes to a temp file which is renamed (or thrown away) afterwards.'''
+        makeDirectories(self.root)
+        temp = os.path.join(self.root, 'store.{}.tmp'.format(threading.current_thread().ident))
+        digest = hashlib.sha1()
+        compressor = zlib.compressobj(ObjectStore.COMPRESSION_LEVEL)
+        try:
+            with open(original, 'rb') as source:
+                with open(temp, 'wb') as destination:
+                    for chunk in iter(lambda: source.read(COPY_CHUNK_SIZE), b''):
+                        digest.update(chunk)
+                        destination.write(compressor.compress(chunk))
+                    destination.write(compressor.flush())
+            digest = digest.hexdigest()
+            if self.findObject(digest)[0] is not None:
+                fileEvents.add('Contents of %s already stored as %s', original, digest)
+                os.unlink(temp)
+                return digest
+            objectPath = self.getObjectPath(digest) + ObjectStore.COMPRESSED_SUFFIX
+            makeDirectories(os.path.dirname(objectPath))
+            os.rename(temp, objectPath)
+        except:
+            if os.path.exists(temp):
+                os.unlink(temp)
+            raise
+        fileEvents.add('Stored %s compressed as %s', original, digest)
+        return digest
+
+    def readObject(self, digest):
+        '''Yield the contents of the object with the given hash a chunk at a time, decompressing it 
+        if need be.'''
+        objectPath, compressed = self.findObject(digest)
+        if objectPath is None:
+            raise IOError(errno.ENOENT, 'No stored object ' + digest, self.getObjectPath(digest))
+        decompressor = zlib.decompressobj() if compressed else None
+        with open(objectPath, 'rb') as f:
+            for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b''):
+                yield decompressor.decompress(chunk) if compressed else chunk
+        if compressed:
+            yield decompressor.flush()
+
+    def hashObject(self, digest):
+        '''Return the hash of the stored contents of an object, to check it hasn't been corrupted.'''
+        actual = hashlib.sha1()
+        for chunk in self.readObject(digest):
+            actual.update(chunk)
+        return actual.hexdigest()
+
+    def restore(self, digest, destination):
+        '''Copy the object with the given hash to destination, emitting a warning if it fails. 
+        Compressed objects are decompressed straight into destination.'''
+        objectPath, compressed = self.findObject(digest)
+        if not compressed:
+            copyOrWarn(objectPath or self.getObjectPath(digest), destination)
+            return
+        try:
+            breakHardLink(destination)
+            with open(destination, 'wb') as output:
+                for chunk in self.readObject(digest):
+                    output.write(chunk)
+        except (OSError, IOError, zlib.error), e:
+            logging.warning("Can't restore %s to %s: %s", objectPath, destination, getattr(e, 'strerror', None) or e)
+
+    def collectGarbage(self, referenced):
+        '''Remove every object whose hash is not in the set referenced.'''
+        if not os.path.isdir(self.root):
+            return
+        removed = 0
+        for prefix in os.listdir(self.root):
+            directory = os.path.join(self.root, prefix)
+            if not os.path.isdir(directory): continue
+            for name in os.listdir(directory):
+                digest = prefix + name
+                if digest.endswith(ObjectStore.COMPRESSED_SUFFIX):
+                    digest = digest[:-len(ObjectStore.COMPRESSED_SUFFIX)]
+                if digest not in referenced:
+                    logging.debug('Removing unreferenced object %s', prefix + name)
+                    removeOrWarn(os.path.join(directory, name))
+                    removed += 1
+            if not os.listdir(directory):
+                os.rmdir(directory)
+        logging.debug('Removed %d unreferenced objects from %s', removed, self.root)
+
 class Backup(object):
-    '''Represents a single backup directory'''
+    '''Represents a single backup directory. The files themselves live in the shared ObjectStore; 
+    the backup's manifest maps paths in the backup tree to the hashes of their contents. (Backups 
+    made by older installers have real files in the tree instead, which are still restored.)'''
 
     # Directory to keep all the backups in, relative to game root
     BACKUP_DIRECTORY = 'Long-War-Backups'
@@ -588,7 +2053,8 @@ class Backup(object):
     METADATA_FILE = 'metadata.json'
     IGNORE_FILES_IN_BACKUP = ['.DS_Store']
     # These attributes will be persisted in metadata.json
-    SERIALIZED_FIELDS = ['applied', 'newModFiles', 'newAppBundleFiles', 'installerVersion', 'active']
+    SERIALIZED_FIELDS = ['applied', 'newModFiles', 'newAppBundleFiles', 'installerVersion', 'active', 'manifest',
+                         'installedFiles']
 
     def __init__(self, version, allBackupsRoot, gameDirectory):
         self.version = version
@@ -600,6 +2066,12 @@ class Backup(object):
         self.gameDirectory = gameDirectory
         self.newModFiles = {}
         self.newAppBundleFiles = {}
+        # Maps paths relative to self.root to the hash of their contents in self.objectStore
+        self.manifest = {}
+        self.objectStore = ObjectStore(allBackupsRoot)
+        # Maps files written by the installer (relative to the game root, or absolute if outside it) 
+        # to [size, mtime, hash] as of installation, for --verify
+        self.installedFiles = {}
         self.metadataFile = os.path.join(self.root, Backup.METADATA_FILE)
         self.applied = None
         self.active = False
@@ -608,11 +2080,25 @@ class Backup(object):
         self.totalAppBundleFiles = 0
         self.installLog = os.path.join(self.root, 'install.log')
         self.uninstallLog = os.path.join(self.root, 'uninstall.log')
+        self.installTimings = os.path.join(self.root, 'install' + PhaseTimer.REPORT_SUFFIX)
+        self.uninstallTimings = os.path.join(self.root, 'uninstall' + PhaseTimer.REPORT_SUFFIX)
+        # Guards the bookkeeping above while Patcher is backing up files on several threads
+        self.lock = threading.Lock()
+        # True if every file backed up is about to be replaced or removed by the installer, so the 
+        # backups can safely be hard links to them
+        self.linkable = False
+        # True to compress files newly added to the object store
+        self.compress = False
+        # While an install is running, the InstallJournal recording its changes to the game tree
+        self.journal = None
+        self.journalFile = os.path.join(self.root, InstallJournal.FILENAME)
         self._loadMetadata()
 
     def __str__(self):
-        return ('{self.version}: installer version {self.installerVersion}, applied at ' +
-                '{self.applied}{active}').format(self=self, active=' (ACTIVE)' if self.active else '')
+        return str(self.getSummary())
+
+    def getSummary(self):
+        return BackupSummary(self.version, self.installerVersion, self.applied, self.active)
 
     def _loadMetadata(self):
         if not os.path.isfile(self.metadataFile):
@@ -643,43 +2129,50 @@ class Backup(object):
         # Check to see whether the file already exists in the game directory; if it doesn't we 
         # will remove it when the user backs out this backup
         if not os.path.exists(gameLocation):
-            logging.debug("File %s doesn't exist in game directory, marking as new", gameLocation)
-            self.newModFiles[patchFile.relativePath] = True
+            fileEvents.add("File %s doesn't exist in game directory, marking as new", gameLocation)
+            with self.lock:
+                self.newModFiles[patchFile.relativePath] = True
+            self._journal('new', path=gameLocation)
             return
 
         self._copyFile(gameLocation, backupLocation)
-        self.totalModFiles += 1
+        with self.lock:
+            self.totalModFiles += 1
 
         # Check for .uncompressed_size files
         if patchFile.isUpk:
             # TODO Make this a gameDirectory method returning None or pathname
             uncompressed = gameLocation + GameDirectory.UNCOMPRESSED_SIZE
             if os.path.isfile(uncompressed):
-                logging.debug('Found uncompressed_size file %s, backing it up...', uncompressed)
+                fileEvents.add('Found uncompressed_size file %s, backing it up...', uncompressed)
                 # This is slightly dirty
                 self._copyFile(uncompressed, backupLocation + GameDirectory.UNCOMPRESSED_SIZE)
 
     def backupOverrideFile(self, patchFile):
         '''Back up a localization file to the override directory inside the .app bundle'''
-        filename = os.path.basename(patchFile.extractedPath)
+        filename = patchFile.filename
         # TODO: this should be a gameDirectory method too
         relativePath = os.path.join(GameDirectory.OVERRIDE_DIRECTORY, filename)
         gameLocation = self.gameDirectory.getAppBundlePath(relativePath)
         if os.path.isfile(gameLocation):
-            logging.debug('Backing up override file %s', gameLocation)
+            fileEvents.add('Backing up override file %s', gameLocation)
             self.backupAppBundleFile(relativePath)
         else:
-            logging.debug('Marking override file %s as new...', relativePath)
-            self.newAppBundleFiles[relativePath] = True
+            fileEvents.add('Marking override file %s as new...', relativePath)
+            with self.lock:
+                self.newAppBundleFiles[relativePath] = True
+            self._journal('new', path=gameLocation)
     
-    def backupFeralDirectory(self):
-        '''Copy all of the files in the feral MacInit directory to the backup'''
-        for filename in os.listdir(self.gameDirectory.feralRoot):
-            original = os.path.join(self.gameDirectory.feralRoot, filename)
+    def backupFeralDirectory(self, source=None):
+        '''Copy all of the files in the feral MacInit directory to the backup, or the files in source 
+        instead if it's given (see FeralSnapshot).'''
+        source = source or self.gameDirectory.feralRoot
+        for filename in os.listdir(source):
+            original = os.path.join(source, filename)
             if not os.path.isfile(original): continue
             target = os.path.join(self.feralRoot, filename)
-            logging.debug('Backing up feral file %s', target)
-            self._copyFile(original, target)
+            fileEvents.add('Backing up feral file %s', target)
+            self._copyFile(original, target, os.path.join(self.gameDirectory.feralRoot, filename))
     
     def copyDistAndScript(self, distFilename):
         '''Copy this installer script and the distribution it was created in into the backup.'''
@@ -689,24 +2182,83 @@ class Backup(object):
             logging.debug('Backing up distribution file %s as %s', original, target)
             copyOrWarn(original, target)
 
-    def _copyFile(self, original, destination):
-        '''Copy original to destination, creating directories if need be'''
-        logging.debug('Backing up %s to %s...', original, destination)
-        parent = os.path.dirname(destination)
-        if not os.path.isdir(parent):
-            os.makedirs(parent)
-        shutil.copy(original, destination)
+    def _copyFile(self, original, destination, gamePath=None):
+        '''Back up original as destination (a path inside the backup tree), storing its contents in 
+        the object store unless they're already there. gamePath is where the file is restored to by 
+        --recover, if that isn't original.'''
+        fileEvents.add('Backing up %s to %s...', original, destination)
+        digest = self.objectStore.store(original, self.linkable, self.compress)
+        with self.lock:
+            self.manifest[getRelativePath(destination, self.root)] = digest
+        self._journal('backup', path=gamePath or original, digest=digest)
+
+    def _journal(self, op, **details):
+        if self.journal is not None:
+            self.journal.record(op, **details)
     
     def backupAppBundleFile(self, relativePath):
         '''Given a file relative to the app bundle root, back it up in the backup tree'''
         original = self.gameDirectory.getAppBundlePath(relativePath)
         backup = self.getAppBundleBackupLocation(relativePath)
-        self.totalAppBundleFiles += 1
+        with self.lock:
+            self.totalAppBundleFiles += 1
         self._copyFile(original, backup)
 
     def getAppBundleBackupLocation(self, relativePath):
         return os.path.join(self.root, Backup.APP_BUNDLE_DIRECTORY, relativePath)
 
+    def recordInstalledFile(self, path):
+        '''Remember the size, modification time and hash of a file the installer has just written.'''
+        stat = os.stat(path)
+        record = [stat.st_size, stat.st_mtime, hashFile(path)]
+        with self.lock:
+            self.installedFiles[self._getInstalledKey(path)] = record
+
+    def _getInstalledKey(self, path):
+        root = self.gameDirectory.root + os.sep
+        return path[len(root):] if path.startswith(root) else path
+
+    def verify(self, jobs=1, quick=False):
+        '''Check that the installed files and the backed-up files haven't changed since installation, 
+        logging any which have. Return True if everything is intact. If quick is True, installed 
+        files whose size and modification time are unchanged are assumed to be intact.'''
+        if not self.installedFiles:
+            logging.warning('Backup "%s" was made by an older installer and has no checksums for '
+                            'installed files; only the backed-up files will be checked.', self.version)
+        logging.info('Verifying %d installed files and %d backed-up files for "%s"...', 
+                     len(self.installedFiles), len(self.manifest), self.version)
+
+        def checkInstalled(item):
+            key, (size, mtime, digest) = item
+            path = os.path.join(self.gameDirectory.root, key)
+            if not os.path.isfile(path):
+                return 'missing', path
+            stat = os.stat(path)
+            if stat.st_size != size:
+                return 'modified', path
+            if quick and stat.st_mtime == mtime:
+                return None
+            return None if hashFile(path) == digest else ('modified', path)
+
+        def checkBackedUp(item):
+            key, digest = item
+            if self.objectStore.findObject(digest)[0] is None:
+                return 'missing from backup', key
+            if quick:
+                return None
+            try:
+                return None if self.objectStore.hashObject(digest) == digest else ('corrupt in backup', key)
+            except zlib.error:
+                return 'corrupt in backup', key
+
+        problems = runInPool(checkInstalled, sorted(self.installedFiles.items()), jobs)
+        problems += runInPool(checkBackedUp, sorted(self.manifest.items()), jobs)
+        problems = [p for p in problems if p is not None]
+        for problem, path in problems:
+            logging.info('%s: %s', problem.capitalize(), path)
+        logging.debug('Verification of %s found %d problems', self.version, len(problems))
+        return not problems
+
     def backupExecutable(self):
         logging.debug('Backing up executable')
         self.backupAppBundleFile(GameDirectory.EXECUTABLE)
@@ -714,58 +2266,115 @@ class Backup(object):
     def deleteBackupTree(self):
         '''Remove entire backup tree'''
         shutil.rmtree(self.root)
+        BackupIndex(self.allBackupsRoot).remove(self.version)
 
     def writeBackupMetadata(self):
         logging.debug('Writing backup metadata...')
         with open(os.path.join(self.root, self.METADATA_FILE), 'w') as output:
             json.dump(self._serialize(), output, indent=2, sort_keys=True)
+        BackupIndex(self.allBackupsRoot).update(self)
 
-    def uninstall(self):
-        '''Restore all files from this backup to the game directory.'''
+    def uninstall(self, jobs=1, restoreFeral=True):
+        '''Restore all files from this backup to the game directory, up to jobs files at once. If 
+        restoreFeral is False, the feral directory is left for restoreFeralDirectory().'''
         self.setupUninstallLog()
 
-        # This could use some refactoring for DRY-related maladies
-        logging.debug('Reverting app bundle files from %s to %s', self.version, self.gameDirectory.root)
-        for root, dirs, files in os.walk(self.appBundleRoot):
-            for backupPath in (os.path.join(root, f) for f in files if f not in Backup.IGNORE_FILES_IN_BACKUP):
-                relativePath = self._getRelativeAppBundlePath(backupPath)
-                gamePath = self.gameDirectory.getAppBundlePath(relativePath)
-                logging.debug('Restoring app bundle path %s to %s', backupPath, gamePath)
-                copyOrWarn(backupPath, gamePath)
-
-        logging.debug('Reverting mod files from %s to %s', self.version, self.gameDirectory.root)
-        for root, dirs, files in os.walk(self.modFileRoot):
-            for backupPath in (os.path.join(root, f) for f in files if f not in Backup.IGNORE_FILES_IN_BACKUP):
-                relativePath = self._getRelativeModFilePath(backupPath)
-                gamePath = self.gameDirectory.getModFilePath(relativePath)
-                logging.debug('Restoring mod file path %s to %s', backupPath, gamePath)
-                copyOrWarn(backupPath, gamePath)
-
+        timer = PhaseTimer()
+
+        # The feral directory is wiped first, since its backed-up files are restored with the rest
+        if restoreFeral:
+            logging.debug('Reverting feral files from %s to %s', self.version, self.feralRoot)
+            with timer.phase('feral', files=0), self.gameDirectory.getFeralLock():
+                self.gameDirectory.nukeFeralDirectory()
+
+        with timer.phase('plan', files=0) as counts:
+            plan = self._getRestorePlan()
+            if not restoreFeral:
+                plan = [step for step in plan if not self._isFeralStep(step)]
+            counts.files = len(plan)
+        logging.debug('Restoring %s with %d actions and %d jobs', self.version, len(plan), jobs)
+        # Every action has a different target, so they can be carried out in any order
+        runInPool(lambda step: self._restore(step, timer), plan, jobs)
+        fileEvents.flush()
+        logCopyStatistics()
+
+        with timer.phase('metadata'):
+            self.active = False
+            self.writeBackupMetadata()
+        timer.writeReport(self.uninstallTimings)
+
+    def restoreFeralDirectory(self):
+        '''Put back just the feral directory from this backup.'''
         logging.debug('Reverting feral files from %s to %s', self.version, self.feralRoot)
-        self.gameDirectory.nukeFeralDirectory()
-        # This should probably be a function
-        for filename in os.listdir(self.feralRoot):
-            original = os.path.join(self.feralRoot, filename)
-            if not os.path.isfile(original): continue
-            target = os.path.join(self.gameDirectory.feralRoot, filename)
-            logging.debug('Restoring feral file %s', original)
-            copyOrWarn(original, target)
-
-        logging.debug('Removing new files added in patch')
-        for addedPath in (self.gameDirectory.getModFilePath(f) for f in self.newModFiles.keys()):
-            logging.debug('Removing mod file %s', addedPath)
-            removeOrWarn(addedPath)
-        for addedPath in (self.gameDirectory.getAppBundlePath(f) for f in self.newAppBundleFiles.keys()):
-            logging.debug('Removing app bundle file %s', addedPath)
-            removeOrWarn(addedPath)
-        self.active = False
-        self.writeBackupMetadata()
-
-    def _getRelativeAppBundlePath(self, absolutePath):
-        return getRelativePath(absolutePath, self.appBundleRoot)
-
-    def _getRelativeModFilePath(self, absolutePath):
-        return getRelativePath(absolutePath, self.modFileRoot)
+        with self.gameDirectory.getFeralLock():
+            self.gameDirectory.nukeFeralDirectory()
+            timer = PhaseTimer()
+            for step in filter(self._isFeralStep, self._getRestorePlan()):
+                self._restore(step, timer)
+        fileEvents.flush()
+
+    def _isFeralStep(self, step):
+        return os.path.dirname(step[2]) == self.gameDirectory.feralRoot
+
+    def _getRestorePlan(self):
+        '''Return a list of (action, source, target) tuples which will put the game directory back 
+        the way it was: 'copy' a file from the backup tree made by an older installer, 'restore' an 
+        object from the object store, or 'remove' a file the mod added.'''
+        plan = []
+        # Backups made by older installers keep real files in the backup tree; find them in one pass
+        gamePathFunctions = {Backup.APP_BUNDLE_DIRECTORY: self.gameDirectory.getAppBundlePath,
+                             Backup.MOD_FILE_DIRECTORY: self.gameDirectory.getModFilePath,
+                             Backup.FERAL_DIRECTORY: lambda f: os.path.join(self.gameDirectory.feralRoot, f)}
+        for directory, getGamePath in sorted(gamePathFunctions.items()):
+            treeRoot = os.path.join(self.root, directory)
+            for root, dirs, files in os.walk(treeRoot):
+                if directory == Backup.FERAL_DIRECTORY:
+                    del dirs[:] # Only files directly inside feral/ were ever backed up
+                for filename in files:
+                    if filename in Backup.IGNORE_FILES_IN_BACKUP: continue
+                    backupPath = os.path.join(root, filename)
+                    if self._isInManifest(backupPath): continue
+                    plan.append(('copy', backupPath, getGamePath(getRelativePath(backupPath, treeRoot))))
+
+        for relativePath, digest in sorted(self.manifest.items()):
+            plan.append(('restore', digest, self._getGamePath(relativePath)))
+
+        for relativePath in sorted(self.newModFiles):
+            plan.append(('remove', None, self.gameDirectory.getModFilePath(relativePath)))
+        for relativePath in sorted(self.newAppBundleFiles):
+            plan.append(('remove', None, self.gameDirectory.getAppBundlePath(relativePath)))
+        return plan
+
+    def _restore(self, step, timer):
+        action, source, target = step
+        if action == 'remove':
+            with timer.phase('remove'):
+                fileEvents.add('Removing new file %s', target)
+                removeOrWarn(target)
+            return
+        with timer.phase('restore') as counts:
+            if action == 'copy':
+                fileEvents.add('Restoring %s to %s', source, target)
+                copyOrWarn(source, target)
+            else:
+                fileEvents.add('Restoring stored file %s to %s', source, target)
+                self.objectStore.restore(source, target)
+            counts.bytes = getSizeOrZero(target)
+
+    def _isInManifest(self, absolutePath):
+        '''True if the given file in the backup tree has been superseded by a manifest entry.'''
+        return getRelativePath(absolutePath, self.root) in self.manifest
+
+    def _getGamePath(self, relativePath):
+        '''Given a path relative to the backup root, return where it was backed up from.'''
+        directory, _, rest = relativePath.partition(os.sep)
+        if directory == Backup.APP_BUNDLE_DIRECTORY:
+            return self.gameDirectory.getAppBundlePath(rest)
+        if directory == Backup.MOD_FILE_DIRECTORY:
+            return self.gameDirectory.getModFilePath(rest)
+        if directory == Backup.FERAL_DIRECTORY:
+            return os.path.join(self.gameDirectory.feralRoot, rest)
+        raise ValueError('Unknown backup path ' + relativePath)
 
     def _getBackupModPath(self, relativePath):
         '''Full path to where this file would belong relative to the given backup folder'''
@@ -794,108 +2403,671 @@ class Backup(object):
             if hasattr(self, attr) and attr in decodedJson:
                 setattr(self, attr, decodedJson[attr])
 
+class BackupSummary(collections.namedtuple('BackupSummary', ['version', 'installerVersion', 'applied', 'active'])):
+    '''The few details of a backup needed to list it or to find the active one.'''
+    __slots__ = ()
+
+    def __str__(self):
+        return ('{self.version}: installer version {self.installerVersion}, applied at ' +
+                '{self.applied}{active}').format(self=self, active=' (ACTIVE)' if self.active else '')
+
+class BackupIndex(object):
+    '''Cache of a BackupSummary for every backup, so that listing the backups or finding the active 
+    one reads a single small file rather than every backup's metadata.json. Each entry remembers the 
+    modification time and size of the metadata it came from, and is re-read when those change.'''
+    INDEX_FILE = 'index.json'
+    # Directories in the backup root which aren't backups
+    IGNORE_DIRECTORIES = ['dist', ObjectStore.DIRECTORY, AbstractExtractor.LOCAL_TEMP_DIRECTORY]
+
+    def __init__(self, backupRoot):
+        self.backupRoot = backupRoot
+        self.indexFile = os.path.join(backupRoot, BackupIndex.INDEX_FILE)
+        # Maps backup directory names to {mtime, size, installerVersion, applied, active}
+        self.entries = {}
+        if os.path.isfile(self.indexFile):
+            with open(self.indexFile) as f:
+                try:
+                    self.entries = json.load(f)
+                except ValueError, e:
+                    logging.warning('Ignoring corrupt backup index %s: %s', self.indexFile, e)
+
+    def read(self):
+        '''Return a dict mapping backup versions to BackupSummary objects, bringing the index up to 
+        date first.'''
+        found = set()
+        changed = False
+        for dirname in os.listdir(self.backupRoot):
+            if dirname in BackupIndex.IGNORE_DIRECTORIES:
+                continue
+            metadata = os.path.join(self.backupRoot, dirname, Backup.METADATA_FILE)
+            if not os.path.isfile(metadata):
+                continue
+            found.add(dirname)
+            stat = os.stat(metadata)
+            entry = self.entries.get(dirname)
+            if entry is None or (entry['mtime'], entry['size']) != (stat.st_mtime, stat.st_size):
+                logging.debug('Backup index is out of date for %s, reading %s', dirname, metadata)
+                self._setEntry(Backup(dirname, self.backupRoot, None), stat)
+                changed = True
+        for dirname in set(self.entries) - found:
+            logging.debug('Removing %s from backup index', dirname)
+            del self.entries[dirname]
+            changed = True
+        if changed:
+            self._writeIndex()
+        return { dirname: BackupSummary(dirname, entry['installerVersion'], entry['applied'], entry['active']) 
+                 for dirname, entry in self.entries.items() }
+
+    def update(self, backup):
+        '''Record the summary of a backup whose metadata has just been written.'''
+        self._setEntry(backup, os.stat(backup.metadataFile))
+        self._writeIndex()
+
+    def remove(self, version):
+        if self.entries.pop(version, None) is not None:
+            self._writeIndex()
+
+    def _setEntry(self, backup, stat):
+        self.entries[backup.version] = {'mtime': stat.st_mtime, 'size': stat.st_size, 'applied': backup.applied,
+                                        'active': backup.active, 'installerVersion': backup.installerVersion}
+
+    def _writeIndex(self):
+        temp = self.indexFile + '.tmp'
+        try:
+            with open(temp, 'w') as output:
+                json.dump(self.entries, output, indent=2, sort_keys=True)
+            os.rename(temp, self.indexFile)
+        except (OSError, IOError), e:
+            # Not fatal, since the index can always be rebuilt from the backups themselves
+            logging.debug("Can't write backup index %s: %s", self.indexFile, e)
+
+class InstallJournal(object):
+    '''Write-ahead log of the changes an install makes to the game tree, kept in the backup directory 
+    while the install runs. Each entry is written before the change it describes, so if the install 
+    is interrupted, --recover can put back exactly the files which were touched. Entries are flushed 
+    as they're written, which is enough to survive the installer being killed, but only synced to 
+    disk in batches so that the journal doesn't slow the install down.'''
+    FILENAME = 'journal.jsonl'
+    # Number of entries between fsync() calls
+    SYNC_INTERVAL = 256
+
+    def __init__(self, path):
+        self.path = path
+        self.output = None
+        self.unsynced = 0
+        self.lock = threading.Lock()
+
+    def begin(self, version):
+        makeDirectories(os.path.dirname(self.path))
+        self.output = open(self.path, 'w')
+        self.record('begin', version=version)
+        self.sync()
+
+    def record(self, op, **details):
+        '''Append an entry: 'backup' (path is about to change; its contents are stored as digest), 
+        'new' (path is about to be created) or 'clear' (every file in the directory path is about to 
+        be removed).'''
+        details['op'] = op
+        line = json.dumps(details) + '\n'
+        with self.lock:
+            self.output.write(line)
+            self.output.flush()
+            self.unsynced += 1
+            if self.unsynced >= InstallJournal.SYNC_INTERVAL:
+                self._sync()
+
+    def sync(self):
+        with self.lock:
+            self._sync()
+
+    def _sync(self):
+        os.fsync(self.output.fileno())
+        self.unsynced = 0
+
+    def commit(self):
+        self.record('commit')
+        self.sync()
+
+    def close(self):
+        if self.output is not None:
+            self.sync()
+            self.output.close()
+            self.output = None
+
+    @staticmethod
+    def read(path):
+        '''Return the entries in the journal at path. The last line may have been cut off if the 
+        installer died while writing it, in which case it's ignored.'''
+        entries = []
+        with open(path) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    logging.debug('Ignoring incomplete journal entry %r', line)
+        return entries
+
+    @staticmethod
+    def rollBack(entries, objectStore):
+        '''Undo the changes described by entries, newest first. Raise MissingBackupObjects without 
+        changing anything if any of the backed-up files are missing from objectStore.'''
+        missing = [entry['path'] for entry in entries 
+                   if entry['op'] == 'backup' and objectStore.findObject(entry['digest'])[0] is None]
+        if missing:
+            for path in missing:
+                logging.error('The backup of %s is missing', path)
+            raise MissingBackupObjects(len(missing))
+        for entry in reversed(entries):
+            op, path = entry['op'], entry.get('path')
+            if op == 'backup':
+                logging.debug('Restoring %s', path)
+                makeDirectories(os.path.dirname(path))
+                objectStore.restore(entry['digest'], path)
+            elif op == 'new':
+                if os.path.isfile(path):
+                    logging.debug('Removing new file %s', path)
+                    removeOrWarn(path)
+            elif op == 'clear':
+                for filename in os.listdir(path):
+                    if os.path.isfile(os.path.join(path, filename)):
+                        logging.debug('Removing file %s', os.path.join(path, filename))
+                        removeOrWarn(os.path.join(path, filename))
+
 class Patcher(object):
     '''Consolidates logic for installing a mod into a tree.'''
 
-    def __init__(self, version, backup, gameDirectory, dryRun=False):
+    def __init__(self, version, backup, gameDirectory, dryRun=False, jobs=1, incremental=False, compress=False, 
+                 feralSnapshot=None):
         self.version = version
         self.backup = backup
         self.gameDirectory = gameDirectory
         self.dryRun = dryRun
+        self.jobs = jobs
+        self.incremental = incremental
+        # For incremental installs, how many files were unchanged, changed or new
+        self.comparisons = collections.Counter()
+        self.lock = threading.Lock()
+        # The installer replaces or deletes everything it backs up, unless this is a dry run
+        self.backup.linkable = not dryRun
+        self.backup.compress = compress
+        self.feralSnapshot = feralSnapshot
+        self.timer = PhaseTimer()
 
     def install(self, extractor):
         logging.debug('Installing mod %s...', self.version)
+        self.backup.installedFiles = {} # Could be left over from an earlier install of this version
 
+        # Every change to the game tree is journaled first, so that --recover can undo a partial install
+        journal = InstallJournal(self.backup.journalFile)
+        journal.begin(self.version)
+        self.backup.journal = journal
+        extractor.timer = self.timer
+        try:
+            self._install(extractor)
+            journal.commit()
+        except (Exception, KeyboardInterrupt):
+            logging.error('Install of "%s" did not finish; run with --recover to undo it', self.version)
+            raise
+        finally:
+            self.backup.journal = None
+            journal.close()
+        os.unlink(journal.path)
+        # Only once the install is committed, since failing to save the timings doesn't undo it
+        self.timer.writeReport(self.backup.installTimings)
+
+    def _install(self, extractor):
         # Back up feral files, then nuke feral directory, then copy and rename new feral files
-        self.backup.backupFeralDirectory()
-        self.gameDirectory.nukeFeralDirectory()
+        snapshot = self.feralSnapshot
+        with self.timer.phase('feral backup', files=0), self.gameDirectory.getFeralLock():
+            self.backup.backupFeralDirectory(snapshot.tmp if snapshot is not None else None)
+            self.backup.journal.record('clear', path=self.gameDirectory.feralRoot)
+            # Other games sharing the snapshot may already have copied their feral files in
+            if snapshot is None or not snapshot.cleared:
+                self.gameDirectory.nukeFeralDirectory()
+                if snapshot is not None:
+                    snapshot.cleared = True
 
         with extractor as extracted:
-            for modFile in extracted.patchFiles:
+            # Each file only touches its own paths, so files can be installed in any order
+            patchFiles = extracted.iterPatchFiles()
+            if extracted.pipeline:
+                patchFiles = iterInBackground(patchFiles, self.jobs * 4)
+            runInPool(self.installFile, patchFiles, self.jobs)
+            fileEvents.flush()
+            logging.debug('Installed %d files with %d jobs', len(extracted.patchFiles), self.jobs)
+
+        logCopyStatistics()
+        if self.incremental:
+            logging.info('Incremental install: %d files unchanged, %d changed, %d new', 
+                         self.comparisons['unchanged'], self.comparisons['changed'], self.comparisons['new'])
+        with self.timer.phase('metadata'):
+            self.backup.active = True
+            self.backup.writeBackupMetadata()
+
+    def installFile(self, modFile):
+        '''Back up a single file from the mod and then overwrite it in the game tree.'''
+        target = self.gameDirectory.getModFilePath(modFile.relativePath)
+        if not self._isUnchanged(modFile, target):
+            with self.timer.phase('backup', bytes=getSizeOrZero(target)):
                 self.backup.backupModFile(modFile)
+            with self.timer.phase('copy', bytes=modFile.getSize()):
                 self.copyModFile(modFile)
                 if modFile.isUpk:
                     self.removeUncompressedSize(modFile)
-                if modFile.isOverride:
+        self._recordInstalledFile(target)
+        if modFile.isOverride:
+            target = self.gameDirectory.getAppBundlePath(modFile.relativePath)
+            if not self._isUnchanged(modFile, target):
+                with self.timer.phase('backup', bytes=getSizeOrZero(target)):
                     self.backup.backupOverrideFile(modFile)
+                with self.timer.phase('copy', bytes=modFile.getSize()):
                     self.copyOverrideFile(modFile)
-                if modFile.feralPath is not None:
-                    self.copyAndRenameFeralFile(modFile)
-
-        self.backup.active = True
-        self.backup.writeBackupMetadata()
+            self._recordInstalledFile(target)
+        if modFile.feralPath is not None:
+            with self.timer.phase('feral', bytes=modFile.getSize()):
+                self.copyAndRenameFeralFile(modFile)
+            self._recordInstalledFile(os.path.join(self.gameDirectory.feralRoot, modFile.feralPath))
+
+    def _recordInstalledFile(self, path):
+        if not self.dryRun and os.path.isfile(path):
+            with self.timer.phase('checksum', bytes=getSizeOrZero(path)):
+                self.backup.recordInstalledFile(path)
+
+    def _isUnchanged(self, modFile, gamePath):
+        '''For incremental installs, return True if gamePath already has the same contents as modFile. 
+        Sizes are compared first so that only files of the same size need to be hashed.'''
+        if not self.incremental:
+            return False
+        with self.timer.phase('compare'):
+            return self._compare(modFile, gamePath)
+
+    def _compare(self, modFile, gamePath):
+        if not os.path.isfile(gamePath):
+            result = 'new'
+        elif os.path.getsize(gamePath) != modFile.getSize():
+            result = 'changed'
+        elif hashFile(gamePath) != modFile.getHash():
+            result = 'changed'
+        else:
+            result = 'unchanged'
+        fileEvents.add('Incremental install: %s is %s', gamePath, result)
+        with self.lock:
+            self.comparisons[result] += 1
+        return result == 'unchanged'
 
     def copyModFile(self, patchfile):
         target = self.gameDirectory.getModFilePath(patchfile.relativePath)
-        logging.debug('Copying mod file %s to %s...', patchfile, target)
+        fileEvents.add('Copying mod file %s to %s...', patchfile, target)
         if not self.dryRun:
-            copyOrWarn(patchfile.extractedPath, target)
+            patchfile.copyTo(target)
 
     def removeUncompressedSize(self, modfile):
         filename = modfile.relativePath + GameDirectory.UNCOMPRESSED_SIZE
         uncompressed = self.gameDirectory.getModFilePath(filename)
         if os.path.exists(uncompressed):
-            logging.debug('Removing uncompressed file %s', uncompressed)
+            fileEvents.add('Removing uncompressed file %s', uncompressed)
             if not self.dryRun:
                 removeOrWarn(uncompressed)
 
     def copyOverrideFile(self, patchfile):
         target = self.gameDirectory.getAppBundlePath(patchfile.relativePath)
-        logging.debug('Copying override file %s to %s...', patchfile, target)
+        fileEvents.add('Copying override file %s to %s...', patchfile, target)
         if not self.dryRun:
-            copyOrWarn(patchfile.extractedPath, target)
+            patchfile.copyTo(target)
     
     def copyAndRenameFeralFile(self, patchfile):
         target = os.path.join(self.gameDirectory.feralRoot, patchfile.feralPath)
-        logging.debug('Copying feral file %s to %s', patchfile, target)
+        fileEvents.add('Copying feral file %s to %s', patchfile, target)
         if not self.dryRun:
-            copyOrWarn(patchfile.extractedPath, target)
+            patchfile.copyTo(target)
         
+class DiskSpacePlanner(object):
+    '''Works out how many bytes an install will need on each filesystem it touches, before anything 
+    is written, and checks that they're free, so that an install which can't fit fails straight away 
+    instead of half way through. The sizes come from the zip's central directory (or the already 
+    extracted files), and the space from statvfs(). Also chooses where to extract the mod: next to 
+    the game if there's room there, so that files aren't copied across devices.'''
+
+    def __init__(self, gameDirectory, extractor, filename, dryRun=False, compress=False):
+        self.gameDirectory = gameDirectory
+        self.extractor = extractor
+        self.filename = filename
+        self.dryRun = dryRun
+        # Backups are hard links to the replaced files, so cost nothing, unless they are compressed
+        self.backupsLinked = not dryRun and not compress
+        # Maps device numbers to [path on that device, bytes needed]
+        self.budget = collections.OrderedDict()
+
+    def plan(self):
+        '''Add up the bytes needed on each filesystem and choose where to extract the mod. Raise 
+        InsufficientDiskSpace, listing every filesystem which is short, if any of them is.'''
+        gameRoot = self.gameDirectory.root
+        # So that filesystems are described by these, rather than whichever file happened to be first
+        self._add(gameRoot, 0)
+        self._add(self.gameDirectory.feralRoot, 0)
+        extractBytes, modFiles = self._readMod()
+        if modFiles is None:
+            # innoextract can't say what's in an installer without unpacking it, so assume the mod is 
+            # at least as big as the installer
+            logging.debug('Estimating the size of %s from the installer', self.filename)
+            self._add(gameRoot, 0 if self.dryRun else extractBytes)
+            modFiles = []
+
+        for modFile in modFiles:
+            size = modFile.getSize()
+            targets = [self.gameDirectory.getModFilePath(modFile.relativePath)]
+            if modFile.isOverride:
+                targets.append(self.gameDirectory.getAppBundlePath(modFile.relativePath))
+            for target in targets:
+                if not self.dryRun:
+                    self._add(target, size)
+                if not self.backupsLinked:
+                    self._add(self.gameDirectory.backupRoot, getSizeOrZero(target))
+            if modFile.feralPath is not None and not self.dryRun:
+                self._add(self.gameDirectory.feralRoot, size)
+
+        feralRoot = self.gameDirectory.feralRoot
+        if os.path.isdir(feralRoot) and (not self.backupsLinked or 
+                                         self._getDevice(feralRoot)[0] != self._getDevice(gameRoot)[0]):
+            self._add(self.gameDirectory.backupRoot, 
+                      sum(getSizeOrZero(os.path.join(feralRoot, name)) for name in os.listdir(feralRoot)))
+        readme = os.path.join(os.path.dirname(self.filename), Distribution.README_FILENAME)
+        self._add(self.gameDirectory.backupRoot, sum(map(getSizeOrZero, [self.filename, __file__, readme])))
+
+        if extractBytes:
+            self._addExtraction(extractBytes)
+        self._check()
+
+    def _readMod(self):
+        '''Return the number of bytes the mod will be extracted as (0 if it won't be extracted), and 
+        the files to install from it, or None if they can't be known until it has been extracted.'''
+        extractor = getattr(self.extractor, 'extractor', self.extractor) # See SharedExtraction
+        if extractor.patchFiles is not None:
+            return 0, extractor.patchFiles
+        if not os.path.isfile(self.filename):
+            raise LongWarFileNotFound(self.filename)
+        extracting = extractor.directory is None and not extractor.stream
+        if not isinstance(extractor, ZipExtractor):
+            return getSizeOrZero(self.filename) if extracting else 0, None
+        with zipfile.ZipFile(self.filename, 'r') as archive:
+            extractBytes = sum(info.file_size for info in archive.infolist()) if extracting else 0
+            return extractBytes, list(extractor._iterArchivePatchFiles(archive))
+
+    def _addExtraction(self, extractBytes):
+        '''Extract to the temp directory if it's on the same filesystem as the game, or else next to 
+        the game if there's room there. Only use a temp directory on another filesystem as a last 
+        resort, since every file would then be copied across devices.'''
+        tempRoot = tempfile.gettempdir()
+        gameDevice, gamePath = self._getDevice(self.gameDirectory.root)
+        if self._getDevice(tempRoot)[0] != gameDevice:
+            needed = self.budget.get(gameDevice, [gamePath, 0])[1] + extractBytes
+            if self._getFreeBytes(gamePath) >= needed:
+                tempRoot = os.path.join(self.gameDirectory.backupRoot, AbstractExtractor.LOCAL_TEMP_DIRECTORY)
+                getattr(self.extractor, 'extractor', self.extractor).tempRoot = tempRoot
+        logging.debug('Extracting %d bytes under %s', extractBytes, tempRoot)
+        self._add(tempRoot, extractBytes)
+
+    def _add(self, path, bytes):
+        device, existing = self._getDevice(path)
+        self.budget.setdefault(device, [existing, 0])[1] += bytes
+
+    def _check(self):
+        shortfalls = []
+        for path, needed in self.budget.values():
+            free = self._getFreeBytes(path)
+            logging.debug('Install needs %d bytes on the filesystem with %s, which has %d free', 
+                          needed, path, free)
+            if needed > free:
+                shortfalls.append((path, needed, free))
+        if shortfalls:
+            raise InsufficientDiskSpace(shortfalls)
+
+    @staticmethod
+    def _getDevice(path):
+        '''Return the device path is on, and path or its closest ancestor which exists.'''
+        path = os.path.abspath(path)
+        while not os.path.exists(path):
+            path = os.path.dirname(path)
+        return os.stat(path).st_dev, path
+
+    @staticmethod
+    def _getFreeBytes(path):
+        stat = os.statvfs(path)
+        return stat.f_bavail * stat.f_frsize
+
 # TODO: refactor into platform-specific subclasses
 class GameDirectoryFinder(object):
+    '''Finds XCOM in the Steam libraries. The libraries are listed in Steam's config files, which are 
+    only parsed when they've changed since the last run; otherwise the game directories found then 
+    are read back from a small cache.'''
     STEAM_LIBRARY_ROOT = '~/Library/Application Support/Steam' 
+    # Where Steam keeps itself on each platform; ~/.steam/steam is usually a link to one of the others
+    STEAM_LIBRARY_ROOTS = [STEAM_LIBRARY_ROOT, '~/.local/share/Steam', '~/.steam/steam']
     STEAM_CONFIG_FILE = 'config/config.vdf'
-    GAME_ROOT = 'SteamApps/common/XCom-Enemy-Unknown'
+    # Older versions of Steam keep this in the steamapps directory, newer ones in config
+    LIBRARY_FOLDERS_FILES = ['SteamApps/libraryfolders.vdf', 'steamapps/libraryfolders.vdf', 
+                             'config/libraryfolders.vdf']
+    # Steam on Linux lower-cases its steamapps directory
+    STEAM_APPS_DIRECTORIES = ['SteamApps', 'steamapps']
+    GAME_ROOT = 'common/XCom-Enemy-Unknown'
+    CACHE_FILE = 'steam-libraries.json'
+    # Bump this when the format of the cache changes
+    CACHE_VERSION = 1
 
     def __init__(self):
-        self.steamRoot = os.path.expanduser(GameDirectoryFinder.STEAM_LIBRARY_ROOT)
-        if not os.path.isdir(self.steamRoot):
-            logging.debug("Can't open steam root at %s", self.steamRoot)
+        self.steamRoots = [os.path.expanduser(root) for root in GameDirectoryFinder.STEAM_LIBRARY_ROOTS]
+        if not any(os.path.isdir(root) for root in self.steamRoots):
+            logging.debug("Can't open steam root at any of %s", ', '.join(self.steamRoots))
             raise SteamDirectoryNotFound()
+        self.cacheFile = os.path.join(GameDirectoryFinder.getCacheDirectory(), GameDirectoryFinder.CACHE_FILE)
+
+    @staticmethod
+    def getCacheDirectory():
+        if sys.platform == 'darwin':
+            return os.path.expanduser('~/Library/Caches/Long-War-Installer')
+        return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 
+                            'long-war-installer')
 
     def find(self):
-        for root in self._findSteamInstallRoots():
-            guess = os.path.join(root, GameDirectoryFinder.GAME_ROOT)
-            if os.path.isdir(guess):
-                return guess
-        raise NoGameDirectoryFound()
+        return self.findAll()[0]
+
+    def findAll(self):
+        '''Return every game directory in any of the Steam libraries.'''
+        games = self._readCache()
+        if games is not None:
+            logging.debug('Using cached game directories from %s', self.cacheFile)
+            return games
+
+        libraries = self._findSteamInstallRoots()
+        games = []
+        seen = set()
+        for library in libraries:
+            for steamApps in GameDirectoryFinder.STEAM_APPS_DIRECTORIES:
+                guess = os.path.join(library, steamApps, GameDirectoryFinder.GAME_ROOT)
+                try:
+                    stat = os.stat(guess)
+                except OSError:
+                    continue
+                # The same directory can turn up under several names (links, case-insensitive filesystems)
+                if os.path.isdir(guess) and (stat.st_dev, stat.st_ino) not in seen:
+                    seen.add((stat.st_dev, stat.st_ino))
+                    games.append(guess)
+        if not games:
+            raise NoGameDirectoryFound()
+        self._writeCache(libraries, games)
+        return games
 
     def _findSteamInstallRoots(self):
-        allRoots = [self.steamRoot] + self._readSteamConfig()
-
-        return allRoots
-
-    def _readSteamConfig(self):
-        '''Grub through the steam config files to find alternate install directories. This is very 
-        simple-minded regex parsing which could easily fail, but it's just a heuristic.'''
+        '''Return every Steam library: the Steam directories themselves, and anything listed in their 
+        config files.'''
+        allRoots = []
+        for steamRoot in self.steamRoots:
+            if os.path.isdir(steamRoot):
+                allRoots.append(steamRoot)
+                allRoots.extend(self._readSteamConfig(steamRoot))
+                allRoots.extend(self._readLibraryFolders(steamRoot))
         result = []
+        for root in allRoots:
+            if os.path.realpath(root) not in map(os.path.realpath, result):
+                result.append(root)
+        return result
 
-        config = os.path.join(self.steamRoot, GameDirectoryFinder.STEAM_CONFIG_FILE)
-        if not os.path.exists(config):
-            logging.debug("Warning: can't open steam config file %s to find alternate install directories", config)
-            return result
+    def _readSteamConfig(self, steamRoot):
+        '''Read the alternate install directories (BaseInstallFolder_N) from Steam's config.vdf.'''
+        config = os.path.join(steamRoot, GameDirectoryFinder.STEAM_CONFIG_FILE)
+        steam = self._readVdf(config, ['InstallConfigStore', 'Software', 'Valve', 'Steam'])
+        result = [value for key, value in steam.items()
+                  if key.lower().startswith('baseinstallfolder') and isinstance(value, basestring)]
+        for folder in result:
+            logging.debug('Found steam install directory %s in %s', folder, config)
+        return result
 
-        with open(config) as f:
-            for line in f:
-                match = re.match(r'^\s*"BaseInstallFolder[^"]+"\s+"(.+)"\s*$', line)
-                if match is not None:
-                    result.append(match.group(1))
-                    logging.debug('Found steam install directory %s', match.group(1))
+    def _readLibraryFolders(self, steamRoot):
+        '''Read the library folders from Steam's libraryfolders.vdf. Older versions map numbers 
+        straight to paths, newer ones to a block of details which includes the path.'''
+        result = []
+        for name in GameDirectoryFinder.LIBRARY_FOLDERS_FILES:
+            filename = os.path.join(steamRoot, name)
+            for key, value in self._readVdf(filename, ['LibraryFolders']).items():
+                if not key.isdigit():
+                    continue
+                if isinstance(value, dict):
+                    value = dict((k.lower(), v) for k, v in value.items()).get('path')
+                if isinstance(value, basestring):
+                    logging.debug('Found steam library folder %s in %s', value, filename)
+                    result.append(value)
         return result
 
+    def _readVdf(self, filename, keys):
+        '''Parse a VDF file and return the block found by following keys (ignoring case), or an empty 
+        dict if the file or the block doesn't exist or the file can't be parsed.'''
+        if not os.path.isfile(filename):
+            logging.debug("Can't open steam config file %s to find alternate install directories", filename)
+            return {}
+        try:
+            with open(filename) as f:
+                node = parseVdf(f)
+        except (IOError, VdfSyntaxError), e:
+            logging.debug("Can't read steam config file %s: %s", filename, e)
+            return {}
+        for key in keys:
+            node = dict((k.lower(), v) for k, v in node.items()).get(key.lower())
+            if not isinstance(node, dict):
+                return {}
+        return node
+
+    def _getCacheStamps(self, libraries):
+        '''Return the modification time and size of everything which could change the game directories 
+        that would be found: the Steam directories and their config files, and the directory of 
+        games in each library. Missing files are None.'''
+        paths = []
+        for steamRoot in self.steamRoots:
+            paths.append(steamRoot)
+            paths.append(os.path.join(steamRoot, GameDirectoryFinder.STEAM_CONFIG_FILE))
+            paths.extend(os.path.join(steamRoot, name) for name in GameDirectoryFinder.LIBRARY_FOLDERS_FILES)
+        for library in libraries:
+            paths.extend(os.path.join(library, steamApps, os.path.dirname(GameDirectoryFinder.GAME_ROOT))
+                         for steamApps in GameDirectoryFinder.STEAM_APPS_DIRECTORIES)
+        stamps = {}
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                stamps[path] = [stat.st_mtime, stat.st_size]
+            except OSError:
+                stamps[path] = None
+        return stamps
+
+    def _readCache(self):
+        '''Return the game directories from the cache, or None if it's missing or out of date.'''
+        try:
+            with open(self.cacheFile) as f:
+                cache = json.load(f)
+            if cache['version'] != GameDirectoryFinder.CACHE_VERSION:
+                return None
+            if self._getCacheStamps(cache['libraries']) != cache['stamps']:
+                logging.debug('Steam libraries have changed since %s was written', self.cacheFile)
+                return None
+            return cache['games']
+        except (IOError, ValueError, KeyError, TypeError):
+            return None
+
+    def _writeCache(self, libraries, games):
+        cache = {'version': GameDirectoryFinder.CACHE_VERSION, 'libraries': libraries, 'games': games, 
+                 'stamps': self._getCacheStamps(libraries)}
+        temp = '{}.{}.tmp'.format(self.cacheFile, os.getpid())
+        try:
+            makeDirectories(os.path.dirname(self.cacheFile))
+            with open(temp, 'w') as output:
+                json.dump(cache, output, indent=2, sort_keys=True)
+            os.rename(temp, self.cacheFile)
+        except (OSError, IOError), e:
+            # Not fatal, the libraries will just be searched again next time
+            logging.debug("Can't write steam library cache %s: %s", self.cacheFile, e)
+
+# Tokens in Valve's KeyValues (VDF) format: comments, quoted or bare strings, braces and [$CONDITIONALS], 
+# then the start of a string which continues on the next line, and anything else (which is an error)
+VDF_TOKEN = re.compile(r'\s*(?:(//.*)|"((?:[^"\\]|\\.)*)"|([{}])|(\[[^\]]*\])|([^\s{}"\[]+)|(")|$|(.))')
+VDF_ESCAPES = {'n': '\n', 't': '\t', '\\': '\\', '"': '"'}
+
+def iterVdfTokens(lines):
+    '''Yield (lineNumber, token, isString) for each token in an iterable of VDF lines. Quoted strings 
+    are unescaped, and may run over several lines.'''
+    pending = ''
+    for lineNumber, line in enumerate(lines, 1):
+        line = pending + line
+        pending = ''
+        position = 0
+        while position < len(line):
+            match = VDF_TOKEN.match(line, position)
+            comment, quoted, brace, condition, bare, openQuote, stray = match.groups()
+            if stray is not None:
+                raise VdfSyntaxError('Unexpected "{}" on line {}'.format(stray, lineNumber))
+            if openQuote is not None:
+                # A quoted string which continues on the next line
+                pending = line[match.start(6):]
+                break
+            if quoted is not None:
+                yield lineNumber, re.sub(r'\\(.)', lambda m: VDF_ESCAPES.get(m.group(1), m.group(0)), quoted), True
+            elif brace is not None:
+                yield lineNumber, brace, False
+            elif bare is not None:
+                yield lineNumber, bare, True
+            elif comment is None and condition is None and match.end() == position:
+                break
+            position = match.end()
+    if pending:
+        raise VdfSyntaxError('Unterminated string at end of file')
+
+def parseVdf(lines):
+    '''Parse VDF from an iterable of lines (such as a file) into nested dicts. Later duplicate keys 
+    replace earlier ones.'''
+    root = {}
+    stack = [root]
+    key = None
+    for lineNumber, token, isString in iterVdfTokens(lines):
+        if token == '{' and not isString:
+            if key is None:
+                raise VdfSyntaxError('Block without a name on line {}'.format(lineNumber))
+            block = stack[-1][key] = {}
+            stack.append(block)
+            key = None
+        elif token == '}' and not isString:
+            if key is not None or len(stack) == 1:
+                raise VdfSyntaxError('Unexpected "}}" on line {}'.format(lineNumber))
+            stack.pop()
+        elif key is None:
+            key = token
+        else:
+            stack[-1][key] = token
+            key = None
+    if key is not None or len(stack) > 1:
+        raise VdfSyntaxError('Unexpected end of file')
+    return root
+
 class ExecutablePatcher(object):
-    '''Code to patch an executable file. This code is pretty simple-minded and loads the whole file 
-    into memory (roughly 40MB).
+    '''Code to patch an executable file (roughly 40MB). The replacements are all the same length as 
+    their targets, so the file is copied and then patched in place through mmap, finding every target 
+    in a single pass; memory use doesn't depend on the size of the file.
 
     NOTE: patching the executable does not currently seem to be necessary for with Mac or Linux.
     This code does seem to work, so it's here in case it will be useful in the future.'''
@@ -912,99 +3084,129 @@ class ExecutablePatcher(object):
     def patch(self):
         '''Read file from self.infile, make replacements, and write changes to self.outfile, 
         overwriting it if it exists. Note that infile and outfile can be the same filename.'''
-        with open(self.infile, 'rb') as input:
-            contents = input.read()
-
-        # This is where the magic happens
-        total = 0
+        replacements = collections.OrderedDict()
         for target, replacement in ExecutablePatcher.PATCH_STRINGS:
             assert len(target) == len(replacement)
-            target, replacement = target.encode('utf-32-be'), replacement.encode('utf-32-be')
-            count = contents.count(target)
-            if count <= 0:
-                logging.warning('Could not find target string "%s" in input file %s', target, self.infile)
-                continue
-            total += count # Hopefully this is accurate
-            contents = contents.replace(target, replacement)
-            logging.debug('Replaced %d occurences of %s in %s', count, target, self.infile)
+            replacements[target.encode('utf-32-be')] = replacement.encode('utf-32-be')
+        pattern = re.compile('|'.join(re.escape(target) for target in replacements))
 
-        with open(self.outfile, 'wb') as output:
-            output.write(contents)
+        # Patch a copy and rename it into place, so outfile is never left half-patched
+        temp = self.outfile + '.patching'
+        copyFile(self.infile, temp)
+        counts = collections.Counter()
+        try:
+            # mmap can't map an empty file, and there would be nothing to replace in it anyway
+            if os.path.getsize(temp) > 0:
+                with open(temp, 'r+b') as f:
+                    contents = mmap.mmap(f.fileno(), 0)
+                    try:
+                        # This is where the magic happens
+                        for match in pattern.finditer(contents):
+                            target = match.group(0)
+                            contents[match.start():match.end()] = replacements[target]
+                            counts[target] += 1
+                        contents.flush()
+                    finally:
+                        contents.close()
+            os.rename(temp, self.outfile)
+        except:
+            removeOrWarn(temp)
+            raise
+
+        for target in replacements:
+            if counts[target] <= 0:
+                logging.warning('Could not find target string "%s" in input file %s', target, self.infile)
+            else:
+                logging.debug('Replaced %d occurences of %s in %s', counts[target], target, self.infile)
+        total = sum(counts.values())
         logging.info('Patched %d strings in "%s" as "%s"', total, self.infile, self.outfile)
 
 class HostsFileScanner(object):
     '''Class which deals with the host file. Note, this uses the "borg pattern" - all instances share 
-    a single state.'''
+    a single state. The file is read once, and changes to it are made to that copy and then written 
+    back all at once, via a temp file which replaces the original.'''
     HOSTS = '/etc/hosts'
-    PATTERNS = [re.compile(r'^[^#\s]*\S+\s+prod\.xcom\.firaxis\.com'),
-                re.compile(r'^[^#\s]*\S+\s+prod\.xcom-ew\.firaxis\.com'),
-                re.compile(r'^\s*#\s*Long-War-Installer:')]
+    # Matches the lines which block phoning home, and the comment before them
+    PATTERN = re.compile(r'^(?:[^#\s]*\S+\s+prod\.xcom(?:-ew)?\.firaxis\.com|\s*#\s*Long-War-Installer:)')
     PHONE_HOME_DISABLE_TEXT = textwrap.dedent('''\
         # Long-War-Installer: if the following two lines are present, XCom phone home is blocked.
         127.0.0.1 prod.xcom-ew.firaxis.com
         127.0.0.1 prod.xcom.firaxis.com
         ''').strip().rstrip()
 
-    # Current state of the hosts file. None if unknown, True if blocked, False if not blocked
-    __blocked = None
+    # Lines of the hosts file (with their line endings), or None if it hasn't been read yet
+    __lines = None
+    # Indexes into __lines of the lines which match PATTERN
+    __xcomLines = None
 
     @property
     def blocked(self):
-        if self.__class__.__blocked is None:
-            self.__class__.__blocked = self._xcomIsBlocked()
-        return self.__class__.__blocked
+        self._load()
+        return bool(self.__class__.__xcomLines)
 
     def unblock(self):
         '''Turn on phoning home by removing xcom entries from the hosts file. Raise AlreadyUnblocked 
         if the file doesn't have those entries in it already.'''
         if not self.blocked:
             raise AlreadyUnblocked
-        count = 0
-        try:
-            logging.debug('Unblocking phone home...')
-            for line in fileinput.input(HostsFileScanner.HOSTS, inplace=1):
-                if any(pattern.match(line) for pattern in HostsFileScanner.PATTERNS):
-                    logging.debug('Removing phone home line %s', line.rstrip())
-                    count += 1
-                else:
-                    sys.stdout.write(line)
-        except (OSError, IOError), e:
-            if e.errno == errno.EACCES:
-                raise PhoneHomePermissionDenied(e)
-            else:
-                raise e
-        logging.info('Removed %d lines from %s to unblock phoning home', count, HostsFileScanner.HOSTS)
-        self._forceRescan()
+        logging.debug('Unblocking phone home...')
+        lines, xcomLines = self.__class__.__lines, set(self.__class__.__xcomLines)
+        for index in sorted(xcomLines):
+            logging.debug('Removing phone home line %s', lines[index].rstrip())
+        self._write([line for index, line in enumerate(lines) if index not in xcomLines])
+        logging.info('Removed %d lines from %s to unblock phoning home', len(xcomLines), HostsFileScanner.HOSTS)
 
     def block(self):
         '''Turn off phoning home by adding xcom entries to the hosts file'''
         if self.blocked:
             raise AlreadyBlocked
+        logging.debug('Disabling phone home...')
+        lines = list(self.__class__.__lines)
+        if lines and not lines[-1].endswith('\n'):
+            lines[-1] += '\n'
+        added = [line + '\n' for line in HostsFileScanner.PHONE_HOME_DISABLE_TEXT.splitlines()]
+        self._write(lines + added)
+        logging.info('Added %d lines to %s to block phoning home', len(added), HostsFileScanner.HOSTS)
+
+    def _load(self):
+        '''Read and parse the hosts file, unless that has already been done.'''
+        if self.__class__.__lines is not None:
+            return
+        logging.debug('Scanning %s for unlock state', HostsFileScanner.HOSTS)
+        with open(HostsFileScanner.HOSTS, 'r') as f:
+            self._parse(f.readlines())
+
+    def _parse(self, lines):
+        self.__class__.__lines = lines
+        self.__class__.__xcomLines = [i for i, line in enumerate(lines) if HostsFileScanner.PATTERN.match(line)]
+
+    def _write(self, lines):
+        '''Replace the hosts file with the given lines. The new contents are written to a temp file 
+        next to it which is then renamed over it, so the hosts file is never left half-written.'''
+        # On OS X /etc is a symlink, which shouldn't be replaced by a regular file
+        hosts = os.path.realpath(HostsFileScanner.HOSTS)
+        temp = None
         try:
-            logging.debug('Disabling phone home...')
-            with open(HostsFileScanner.HOSTS, 'a') as f:
-                f.write(HostsFileScanner.PHONE_HOME_DISABLE_TEXT)
+            stat = os.stat(hosts)
+            fd, temp = tempfile.mkstemp(prefix='.hosts.', dir=os.path.dirname(hosts))
+            with os.fdopen(fd, 'w') as output:
+                output.writelines(lines)
+                output.flush()
+                os.fsync(output.fileno())
+            os.chmod(temp, stat.st_mode & 07777)
+            if (stat.st_uid, stat.st_gid) != (os.getuid(), os.getgid()):
+                os.chown(temp, stat.st_uid, stat.st_gid)
+            os.rename(temp, hosts)
+            temp = None
         except (OSError, IOError), e:
-            if e.errno == errno.EACCES:
+            if e.errno in (errno.EACCES, errno.EPERM):
                 raise PhoneHomePermissionDenied(e)
             else:
                 raise e
-        count = sum(1 for line in HostsFileScanner.PHONE_HOME_DISABLE_TEXT.splitlines())
-        logging.info('Added %d lines to %s to block phoning home', count, HostsFileScanner.HOSTS)
-        self._forceRescan()
-
-    def _forceRescan(self):
-        '''Rescan hosts file on next access to self.blocked.'''
-        self.__class__.__blocked = None
-
-    def _xcomIsBlocked(self):
-        '''Scan hosts file. If a known XCom hosts entry is found, return True, else return False.'''
-        logging.debug('Scanning %s for unlock state', HostsFileScanner.HOSTS)
-        with open(HostsFileScanner.HOSTS, 'r') as f:
-            for line in f:
-                if any(pattern.match(line.rstrip()) for pattern in HostsFileScanner.PATTERNS):
-                    return True
-        return False
+        finally:
+            if temp is not None and os.path.exists(temp):
+                os.unlink(temp)
+        self._parse(lines)
 
 class Distribution(object):
     '''Code to create distributions (packaged files which can be uploaded websites for distribution).
@@ -1018,8 +3220,10 @@ class Distribution(object):
     # Filenames that match any of these patterns will not be included in the final zip file
     IGNORE_PATTERNS = [r'/Long War Files/', r'__MACOSX/', r'/\._', r'\.DS_Store']
 
-    def __init__(self, files):
+    def __init__(self, files, jobs=1, cacheSize=None):
         self.files = files
+        self.jobs = jobs
+        self.cache = ExtractionCache(cacheSize)
         self.version = AbstractExtractor.modName(files[0])
         self.appendix = datetime.date.today().strftime('%Y-%m-%d')
         self.distName = '{v}.{d}.OSX'.format(v=self.version, d=datetime.date.today().strftime('%Y-%m-%d'))
@@ -1090,12 +3294,15 @@ class Distribution(object):
         temp directory. Create a zip file in distDir with a name based on self.version, and return its path.'''
         zipName = os.path.join(distDir, self.version + '-OSX.zip')
         with TempDirectory('LongWar_Zip_') as zipDir: 
-            # Extract every file to a directory
+            # Extract every file to a directory, via the cache
             for filename in self.files:
-                with getExtractor(filename, zipDir) as extracted:
-                    logging.debug('Extracted source file %s', filename)
+                extracted = self.cache.getExtractedTree(filename)
+                overlayDirectory(extracted, zipDir)
+                logging.debug('Extracted source file %s', filename)
+            # The overlay is linked or copied out of the cache, so it can be shrunk to its limit now
+            self.cache.trim()
             # Now create a zip file
-            self.totalFiles = zipUpDirectory(zipName, zipDir, self._skipFilter)
+            self.totalFiles = zipUpDirectory(zipName, zipDir, self._skipFilter, jobs=self.jobs)
         return zipName
 
     def _skipFilter(self, filePath):
@@ -1117,10 +3324,119 @@ class Distribution(object):
         if os.path.isfile(zipDist):
             logging.info('Removing previous installation image %s', zipDist)
             removeOrWarn(zipDist)
-        zipUpDirectory(zipDist, distDir, self._skipFilter, topLevelPrefix=self.version)
+        zipUpDirectory(zipDist, distDir, self._skipFilter, topLevelPrefix=self.version, jobs=self.jobs)
         logging.debug('Created %s from %s', zipDist, distDir)
 
-def zipUpDirectory(zipName, zipDir, skipFilter=None, topLevelPrefix=''):
+class ExtractionCache(object):
+    '''On-disk cache of extracted installation files, so that building distributions repeatedly from 
+    the same sources doesn't need to run innoextract every time. Entries are keyed by the hash of the 
+    source file's contents; the source's path, size and modification time are remembered so that 
+    unchanged files don't need to be hashed again. The least recently used entries are removed when 
+    the cache grows past its maximum size.'''
+    DIRECTORY = os.path.join('dist', 'extract-cache')
+    INDEX_FILE = 'index.json'
+    DEFAULT_SIZE_MB = 4096
+
+    def __init__(self, maxSizeMB=None):
+        self.root = ExtractionCache.DIRECTORY
+        if maxSizeMB is None:
+            maxSizeMB = ExtractionCache.DEFAULT_SIZE_MB
+        self.maxBytes = maxSizeMB * 1024 * 1024
+        self.indexFile = os.path.join(self.root, ExtractionCache.INDEX_FILE)
+        # Maps entry names (also their directory names) to {source, size, mtime, bytes, lastUsed}
+        self.entries = {}
+        if os.path.isfile(self.indexFile):
+            with open(self.indexFile) as f:
+                try:
+                    self.entries = json.load(f)
+                except ValueError, e:
+                    logging.warning('Ignoring corrupt cache index %s: %s', self.indexFile, e)
+
+    def getExtractedTree(self, filename):
+        '''Return the path to a directory containing the extracted contents of filename, extracting 
+        it into the cache first if need be.'''
+        if not os.path.isfile(filename):
+            raise LongWarFileNotFound(filename)
+        stat = os.stat(filename)
+        source = os.path.abspath(filename)
+        name = self._findUnchanged(source, stat)
+        if name is None:
+            _, extension = os.path.splitext(filename)
+            name = hashFile(filename) + extension
+            if name not in self.entries or not os.path.isdir(os.path.join(self.root, name)):
+                self._extract(filename, name)
+        else:
+            logging.debug('Extraction cache hit for %s', filename)
+        self.entries[name].update(source=source, size=stat.st_size, mtime=stat.st_mtime, lastUsed=time.time())
+        self._evict(keep=name)
+        self._writeIndex()
+        return os.path.join(self.root, name)
+
+    def _findUnchanged(self, source, stat):
+        '''Return the name of the entry last seen for this exact path, size and mtime, if any.'''
+        for name, entry in self.entries.items():
+            if (entry['source'], entry['size'], entry['mtime']) == (source, stat.st_size, stat.st_mtime):
+                if os.path.isdir(os.path.join(self.root, name)):
+                    return name
+        return None
+
+    def _extract(self, filename, name):
+        logging.debug('Extraction cache miss for %s, extracting as %s', filename, name)
+        makeDirectories(self.root)
+        target = os.path.join(self.root, name)
+        temp = target + '.partial'
+        if os.path.isdir(temp):
+            shutil.rmtree(temp)
+        with getExtractor(filename, temp):
+            pass
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+        os.rename(temp, target)
+        size = sum(os.path.getsize(os.path.join(root, f)) for root, dirs, files in os.walk(target) for f in files)
+        self.entries[name] = {'bytes': size}
+
+    def trim(self):
+        '''Remove least recently used entries until the cache is within its maximum size, including 
+        the ones most recently returned by getExtractedTree(), which must no longer be in use.'''
+        self._evict(keep=None)
+        self._writeIndex()
+
+    def _evict(self, keep):
+        '''Remove least recently used entries (other than keep) until the cache is small enough.'''
+        total = sum(entry['bytes'] for entry in self.entries.values())
+        for name in sorted(self.entries, key=lambda n: self.entries[n]['lastUsed']):
+            if total <= self.maxBytes:
+                break
+            if name == keep:
+                continue
+            logging.debug('Evicting %s from extraction cache', name)
+            total -= self.entries.pop(name)['bytes']
+            shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+
+    def _writeIndex(self):
+        temp = self.indexFile + '.tmp'
+        with open(temp, 'w') as output:
+            json.dump(self.entries, output, indent=2, sort_keys=True)
+        os.rename(temp, self.indexFile)
+
+    def clear(self):
+        '''Remove everything in the cache.'''
+        if os.path.isdir(self.root):
+            shutil.rmtree(self.root)
+        self.entries = {}
+        logging.info('Cleared extraction cache %s', self.root)
+
+def overlayDirectory(source, destination):
+    '''Copy every file under source into the same place under destination, replacing any files that 
+    are already there. Files are hard linked where possible; copyFile() breaks the link before 
+    anything writes to them.'''
+    for root, dirs, files in os.walk(source):
+        targetRoot = os.path.join(destination, getRelativePath(root, source)) if root != source else destination
+        makeDirectories(targetRoot)
+        for filename in files:
+            copyFile(os.path.join(root, filename), os.path.join(targetRoot, filename), allowLink=True)
+
+def zipUpDirectory(zipName, zipDir, skipFilter=None, topLevelPrefix='', jobs=1):
     '''Create a zip file containing the entire contents of zipDir directory. The pathnames in the 
     zip archive will be relative to the directory given, so zipping '/tmp/root', where root contains 
     'foo/bar.txt' and 'bar.txt', will result in a zip file containing 'bar'txt' at the top level 
@@ -1128,39 +3444,81 @@ def zipUpDirectory(zipName, zipDir, skipFilter=None, topLevelPrefix=''):
     single-argument function with each filename in turn, and only filenames for which it returns 
     True will be included in the resulting zip file.
 
-    Return the total amount of files included in the zip file.'''
+    Files are compressed on jobs worker threads, but are always written to the zip file in the same 
+    (sorted) order. Return the total amount of files included in the zip file.'''
 
-    def addExecutableFile(zipFile, fullPath, relativePath, compression):
-        '''Add a file to the .zip file, including executable permissions in the info-zip metadata.'''
-        # cf http://stackoverflow.com/a/434689/87990
-        info = zipfile.ZipInfo(fullPath)
-        info.external_attr = 0755 << 16L
-        info.filename = relativePath
-        with open(fullPath) as f:
-            contents = f.read()
-        zipFile.writestr(info, contents, compression)
-
-    totalFiles = 0
-    with zipfile.ZipFile(zipName, 'w', zipfile.ZIP_DEFLATED) as resultZip:
-        relRoot = os.path.abspath(os.path.join(zipDir, os.pardir))
+    def findFiles():
         for root, dirs, files in os.walk(zipDir):
-            for basename in files:
+            dirs.sort()
+            for basename in sorted(files):
                 fullPath = os.path.join(root, basename)
                 if skipFilter is not None and skipFilter(fullPath):
-                    logging.debug('Skipping filtered path %s', fullPath)
+                    fileEvents.add('Skipping filtered path %s', fullPath)
                     continue
                 relativePath = os.path.join(topLevelPrefix, getRelativePath(fullPath, zipDir))
                 if os.path.isfile(fullPath): # regular files only
                     _, extension = os.path.splitext(fullPath)
                     compression = zipfile.ZIP_STORED if extension in ['.zip'] else zipfile.ZIP_DEFLATED
-                    logging.debug('Adding %s to zip as %s', fullPath, relativePath)
-                    if os.access(fullPath, os.X_OK):
-                        addExecutableFile(resultZip, fullPath, relativePath, compression)
-                    else:
-                        resultZip.write(fullPath, relativePath, compression)
-                    totalFiles += 1
+                    yield fullPath, relativePath, compression
+
+    totalFiles = 0
+    with zipfile.ZipFile(zipName, 'w', zipfile.ZIP_DEFLATED) as resultZip:
+        for member in imapOrdered(_compressZipMember, findFiles(), jobs):
+            _writeZipMember(resultZip, *member)
+            totalFiles += 1
+    fileEvents.flush()
     return totalFiles
 
+def _compressZipMember(member):
+    '''Read a file for zipUpDirectory() a chunk at a time, working out its CRC and compressing it 
+    into a temp file if need be. Return the ZipInfo for it, plus the compressed data (None if it 
+    is to be stored uncompressed, in which case it will be read from fullPath again).'''
+    fullPath, relativePath, compression = member
+    stat = os.stat(fullPath)
+    info = zipfile.ZipInfo(relativePath, time.localtime(stat.st_mtime)[:6])
+    # Keeps permissions (and so executable bits) in the info-zip metadata, cf http://stackoverflow.com/a/434689/87990
+    info.external_attr = (stat.st_mode & 0xFFFF) << 16L
+    info.compress_type = compression
+
+    crc, size = 0, 0
+    compressed = None
+    if compression == zipfile.ZIP_DEFLATED:
+        compressed = tempfile.SpooledTemporaryFile(max_size=8 * COPY_CHUNK_SIZE)
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    with open(fullPath, 'rb') as f:
+        for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            if compressed is not None:
+                compressed.write(compressor.compress(chunk))
+    info.CRC = crc & 0xffffffff
+    info.file_size = info.compress_size = size
+    if compressed is not None:
+        compressed.write(compressor.flush())
+        info.compress_size = compressed.tell()
+        compressed.seek(0)
+    return fullPath, info, compressed
+
+def _writeZipMember(zipFile, fullPath, info, compressed):
+    '''Append a member prepared by _compressZipMember() to zipFile. This mirrors ZipFile.writestr(), 
+    minus the compression.'''
+    fileEvents.add('Adding %s to zip as %s', fullPath, info.filename)
+    zip64 = info.file_size > zipfile.ZIP64_LIMIT or info.compress_size > zipfile.ZIP64_LIMIT
+    if zip64 and not zipFile._allowZip64:
+        raise zipfile.LargeZipFile('Filesize would require ZIP64 extensions')
+    info.header_offset = zipFile.fp.tell()
+    zipFile._writecheck(info)
+    zipFile._didModify = True
+    zipFile.fp.write(info.FileHeader(zip64))
+    if compressed is None:
+        with open(fullPath, 'rb') as f:
+            shutil.copyfileobj(f, zipFile.fp, COPY_CHUNK_SIZE)
+    else:
+        shutil.copyfileobj(compressed, zipFile.fp, COPY_CHUNK_SIZE)
+        compressed.close()
+    zipFile.filelist.append(info)
+    zipFile.NameToInfo[info.filename] = info
+
 
 # Errors. These might be a bit out of control, but they simplify the script error handling somewhat
 class InstallError(Exception): pass
@@ -1176,10 +3534,17 @@ class EnemyWithinNotFound(InstallError): pass
 class ActiveBackupFoundDuringInstall(InstallError): pass
 class ActiveBackupFoundDuringDelete(InstallError): pass
 class NoActiveBackupFoundDuringUninstall(InstallError): pass
+class NoActiveBackupFoundDuringVerify(InstallError): pass
+class MissingBackupObjects(InstallError): pass
 class NoInstallationFilesFound(InstallError): pass
 class TooManyInstallationFilesFound(InstallError): pass
 class AlreadyBlocked(InstallError): pass
 class AlreadyUnblocked(InstallError): pass
+class VerificationFailed(InstallError): pass
+class CommandTimedOut(InstallError): pass
+class InterruptedInstallFound(InstallError): pass
+class VdfSyntaxError(InstallError): pass
+class InsufficientDiskSpace(InstallError): pass
 
 
 if __name__ == '__main__': main()